@@ -1,21 +1,36 @@
-from fastapi import FastAPI
+import time
+IMPORT_STARTED = time.perf_counter()  # đo thời gian import module (cold start)
+from fastapi import FastAPI, HTTPException, Response
 from pydantic import BaseModel
 from fastapi.middleware.cors import CORSMiddleware
-from pymongo import MongoClient
+from fastapi.responses import StreamingResponse
+from pymongo import AsyncMongoClient, ASCENDING, DESCENDING
+from pymongo.errors import BulkWriteError
+from bson import ObjectId
+from bson.errors import InvalidId
+import base64
+from collections import OrderedDict, deque
+import asyncio
 import os
 import datetime
 import httpx
+import re
+import unicodedata
+import hashlib
+import json
+import redis.asyncio as aioredis
+import math
+import functools
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, generate_latest
 from typing import Literal
 
 # --- 1. Import (THAY ĐỔI: Thêm AIMessage) ---
-from langchain_openai import ChatOpenAI
+# langchain_openai, langchain.agents và langgraph rất nặng (~1.5s): chỉ import trong build_agent_runtime()
 from langchain.tools import tool
 from langchain.tools.render import render_text_description
-from langchain.agents import AgentExecutor, create_tool_calling_agent
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.pydantic_v1 import BaseModel as LangchainBaseModel, Field
 from langchain_core.messages import HumanMessage, AIMessage # <-- THÊM AIMessage
-from langgraph.graph import StateGraph, END 
 from typing import TypedDict, Annotated, Sequence
 from langchain_core.messages import BaseMessage
 import operator
@@ -23,10 +38,133 @@ import operator
 # --- 2. Khởi tạo (Không đổi) ---
 MONGO_URI = os.getenv("MONGO_URI", "mongodb://localhost:27017/")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+REDIS_HOST = os.getenv("REDIS_HOST", "localhost")
+redis_client = None
+# Bộ đệm lịch sử chat trong process (ring buffer mỗi user) để phần lớn request không phải đọc MongoDB
+HISTORY_LIMIT = 10  # số bản ghi (cặp hỏi-đáp) đưa vào bối cảnh
+HISTORY_CACHE_USERS = int(os.getenv("HISTORY_CACHE_USERS", "10000"))
+HISTORY_CACHE_TTL = float(os.getenv("HISTORY_CACHE_TTL", "300"))  # nạp lại từ Mongo sau thời gian này
+HISTORY_PROJECTION = {"_id": 0, "prompt": 1, "response": 1, "timestamp": 1}
+history_cache: OrderedDict[str, tuple[float, deque]] = OrderedDict()  # user_id -> (thời điểm nạp, bản ghi cũ -> mới)
+# Bối cảnh gửi cho LLM: ngân sách token theo route, các lượt gần nhất giữ nguyên văn,
+# các lượt cũ hơn được gộp dần vào 1 bản tóm tắt cuốn chiếu (mỗi user, lưu MongoDB)
+CONTEXT_TOKEN_BUDGETS = {
+    "crypto_tools": int(os.getenv("CONTEXT_BUDGET_CRYPTO", "1200")),
+    "general_chat": int(os.getenv("CONTEXT_BUDGET_GENERAL", "2000")),
+}
+ROUTER_CONTEXT_TOKENS = int(os.getenv("ROUTER_CONTEXT_TOKENS", "150"))  # router chỉ thấy câu hỏi trước đó (cắt ngắn)
+CONTEXT_RECENT_TURNS = int(os.getenv("CONTEXT_RECENT_TURNS", "4"))  # số lượt hỏi-đáp giữ nguyên văn
+CONTEXT_MESSAGE_MAX_TOKENS = int(os.getenv("CONTEXT_MESSAGE_MAX_TOKENS", "400"))  # cắt câu trả lời quá dài
+SUMMARY_MAX_TOKENS = int(os.getenv("SUMMARY_MAX_TOKENS", "300"))
+# Chỉ gọi LLM tóm tắt khi đã dồn đủ N lượt rời cửa sổ nguyên văn (1 lần gọi cho N lượt thay vì mỗi lượt 1 lần).
+# Không vượt số lượt ring buffer còn giữ ngoài cửa sổ, để lượt cũ không bị đẩy ra trước khi kịp tóm tắt.
+SUMMARY_MIN_PENDING_TURNS = max(1, min(
+    int(os.getenv("SUMMARY_MIN_PENDING_TURNS", "4")), HISTORY_LIMIT - CONTEXT_RECENT_TURNS
+))
+SUMMARY_MAX_CONCURRENT = int(os.getenv("SUMMARY_MAX_CONCURRENT", "2"))  # số lần gọi LLM tóm tắt chạy cùng lúc
+summary_semaphore: asyncio.Semaphore | None = None
+summary_cache: OrderedDict[str, dict] = OrderedDict()  # user_id -> {"summary", "covered_until"}
+summary_tasks: dict[str, asyncio.Task] = {}  # mỗi user tối đa 1 lần cập nhật tóm tắt đang chạy
+context_stats = {
+    "summary_updates": 0, "summary_errors": 0, "summary_skipped_busy": 0, "summary_deferred": 0, "dropped_turns": 0,
+}
+token_encoding = None
+# Ghi chat kiểu write-behind: request chỉ đẩy bản ghi vào hàng đợi, 1 task nền gom lại insert_many
+CHAT_WRITE_QUEUE_SIZE = int(os.getenv("CHAT_WRITE_QUEUE_SIZE", "5000"))  # giới hạn bộ nhớ
+CHAT_WRITE_BATCH_SIZE = int(os.getenv("CHAT_WRITE_BATCH_SIZE", "200"))
+CHAT_WRITE_FLUSH_INTERVAL = float(os.getenv("CHAT_WRITE_FLUSH_INTERVAL", "0.5"))  # giây
+CHAT_WRITE_ENQUEUE_TIMEOUT = float(os.getenv("CHAT_WRITE_ENQUEUE_TIMEOUT", "2.0"))  # hàng đợi đầy quá lâu -> ghi trực tiếp
+CHAT_WRITE_MAX_RETRIES = 3
+chat_write_queue: asyncio.Queue | None = None
+chat_writer_task: asyncio.Task | None = None
+chat_writer_stats = {"enqueued": 0, "written": 0, "batches": 0, "direct_writes": 0, "dropped": 0}
+# Kiểm soát tải: giới hạn số lần chạy Graph đồng thời (toàn cục + mỗi user), hàng đợi có hạn + deadline
+ADMISSION_MAX_CONCURRENT = int(os.getenv("ADMISSION_MAX_CONCURRENT", "16"))
+ADMISSION_MAX_PER_USER = int(os.getenv("ADMISSION_MAX_PER_USER", "2"))  # đang chạy + đang chờ
+ADMISSION_QUEUE_SIZE = int(os.getenv("ADMISSION_QUEUE_SIZE", "64"))
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "10"))  # giây chờ tối đa trong hàng đợi
+run_semaphore: asyncio.Semaphore | None = None
+runs_in_flight = 0
+runs_waiting = 0
+user_runs: dict[str, int] = {}  # user_id -> số lượt đang chạy + đang chờ
+inflight_chats: dict[tuple[str, str], asyncio.Task] = {}  # (user_id, prompt chuẩn hóa) -> lượt chat đang chạy
+run_seconds_avg = 5.0  # trung bình trượt thời gian 1 lượt chat (để ước lượng Retry-After)
 db = None
+mongo_client = None
+# Bộ não AI (LLM, executor, Graph) được dựng lazily: nền ngay sau startup, hoặc ở request đầu tiên nếu chưa xong
+llm = None
+crypto_agent_executor = None
+general_agent_executor = None
 graph_app = None 
+agent_runtime_task: asyncio.Task | None = None
+IMPORT_TIME_BUDGET = float(os.getenv("IMPORT_TIME_BUDGET", "1.5"))  # giây; vượt ngưỡng -> in cảnh báo
+TRADING_HTTP_WARM_CONNECTIONS = int(os.getenv("TRADING_HTTP_WARM_CONNECTIONS", "4"))
+readiness = {"agent_runtime": False, "mongo": False, "http_warm": False, "tokenizer": False, "import_seconds": None, "runtime_init_seconds": None, "error": None}
 TRADING_SERVICE_URL = "http://trading-service:8000"
 
+# HTTP client dùng chung cho mọi tool (keep-alive, tạo lúc startup, đóng lúc shutdown)
+trading_http_client: httpx.AsyncClient | None = None
+TRADING_HTTP_LIMITS = httpx.Limits(
+    max_connections=int(os.getenv("TRADING_HTTP_MAX_CONNECTIONS", "50")),
+    max_keepalive_connections=int(os.getenv("TRADING_HTTP_MAX_KEEPALIVE", "20")),
+    keepalive_expiry=30.0,
+)
+# Timeout riêng cho từng tool (giây)
+TOOL_TIMEOUTS = {
+    "get_sol_price": 5.0,
+    "get_pumpfun_coin_info": 10.0,
+    "create_pumpfun_token_tool": 60.0,
+    "execute_swap_tool": 60.0,
+}
+
+# Memo ngắn hạn cho tool CHỈ ĐỌC, dùng chung giữa các lượt chat và các user (tool swap / tạo token không bao giờ memo)
+TOOL_MEMO_TTLS = {
+    "get_sol_price": float(os.getenv("TOOL_MEMO_PRICE_TTL", "2")),
+    "get_pumpfun_coin_info": float(os.getenv("TOOL_MEMO_PUMPFUN_TTL", "30")),
+}
+TOOL_MEMO_MAX_ENTRIES = int(os.getenv("TOOL_MEMO_MAX_ENTRIES", "1000"))
+tool_memo: OrderedDict[tuple[str, str], tuple[float, str]] = OrderedDict()  # (tool, tham số) -> (hết hạn lúc, kết quả)
+tool_memo_inflight: dict[tuple[str, str], asyncio.Task] = {}
+tool_memo_stats = {"hits": 0, "misses": 0, "joined": 0}
+
+def get_trading_client() -> httpx.AsyncClient:
+    if trading_http_client is None:
+        raise Exception("HTTP Client (trading-service) chưa được khởi tạo")
+    return trading_http_client
+
+async def memoized_tool_call(tool_name: str, args_key: str, fetch) -> str:
+    """
+    Trả kết quả còn hạn trong memo; nếu không, các lời gọi trùng (tool, tham số) chờ chung 1 lần gọi
+    trading-service (single-flight). Kết quả lỗi ("Lỗi: ...") không được lưu.
+    """
+    key = (tool_name, args_key)
+    entry = tool_memo.get(key)
+    if entry is not None and entry[0] > time.monotonic():
+        tool_memo.move_to_end(key)
+        tool_memo_stats["hits"] += 1
+        return entry[1]
+    task = tool_memo_inflight.get(key)
+    if task is not None:
+        tool_memo_stats["joined"] += 1
+        return await asyncio.shield(task)
+
+    async def run() -> str:
+        try:
+            result = await fetch()
+            if not result.startswith("Lỗi"):
+                tool_memo[key] = (time.monotonic() + TOOL_MEMO_TTLS[tool_name], result)
+                tool_memo.move_to_end(key)
+                while len(tool_memo) > TOOL_MEMO_MAX_ENTRIES:
+                    tool_memo.popitem(last=False)
+            return result
+        finally:
+            tool_memo_inflight.pop(key, None)
+
+    tool_memo_stats["misses"] += 1
+    task = asyncio.create_task(run())
+    tool_memo_inflight[key] = task
+    return await asyncio.shield(task)
+
 # --- 3. Định nghĩa CÔNG CỤ (Tools) ---
 # (Toàn bộ các Tool 1, 2, 3, 4 đều giữ nguyên)
 
@@ -38,15 +176,20 @@ async def get_sol_price() -> str:
     Nó sẽ gọi đến service trading để lấy giá, có thể từ cache hoặc API.
     """
     print("AI Agent: Đang kích hoạt công cụ get_sol_price...")
-    try:
-        async with httpx.AsyncClient() as client:
-            response = await client.get(f"{TRADING_SERVICE_URL}/api/v1/price/SOL-USDT")
+
+    async def fetch() -> str:
+        try:
+            response = await get_trading_client().get(
+                "/api/v1/price/SOL-USDT", timeout=TOOL_TIMEOUTS["get_sol_price"]
+            )
             response.raise_for_status()
             data = response.json()
             return str(data) 
-    except Exception as e:
-        print(f"Lỗi khi gọi trading service: {e}")
-        return "Lỗi: Không thể kết nối đến service trading."
+        except Exception as e:
+            print(f"Lỗi khi gọi trading service: {e}")
+            return "Lỗi: Không thể kết nối đến service trading."
+
+    return await memoized_tool_call("get_sol_price", "SOL-USDT", fetch)
 
 # --- Tool 2: Get Pump.fun Info ---
 class PumpFunInfoInput(LangchainBaseModel):
@@ -58,16 +201,21 @@ async def get_pumpfun_coin_info(contract_address: str) -> str:
     trên Pump.fun, sử dụng địa chỉ contract của nó.
     """
     print(f"AI Agent: Đang kích hoạt công cụ get_pumpfun_coin_info cho {contract_address}...")
-    try:
-        async with httpx.AsyncClient() as client:
-            url = f"{TRADING_SERVICE_URL}/api/v1/pumpfun/coin/{contract_address}"
-            response = await client.get(url)
+    contract_address = contract_address.strip()
+
+    async def fetch() -> str:
+        try:
+            response = await get_trading_client().get(
+                f"/api/v1/pumpfun/coin/{contract_address}", timeout=TOOL_TIMEOUTS["get_pumpfun_coin_info"]
+            )
             response.raise_for_status()
             data = response.json()
             return str(data)
-    except Exception as e:
-        print(f"Lỗi khi gọi trading service (Pump.fun): {e}")
-        return "Lỗi: Không thể lấy dữ liệu từ Pump.fun qua trading service."
+        except Exception as e:
+            print(f"Lỗi khi gọi trading service (Pump.fun): {e}")
+            return "Lỗi: Không thể lấy dữ liệu từ Pump.fun qua trading service."
+
+    return await memoized_tool_call("get_pumpfun_coin_info", contract_address, fetch)
 
 # --- Tool 3: Create Token ---
 class CreateTokenToolInput(LangchainBaseModel):
@@ -94,12 +242,13 @@ async def create_pumpfun_token_tool(
     """
     print(f"AI Agent: Đang kích hoạt công cụ create_pumpfun_token_tool cho: {symbol}")
     try:
-        async with httpx.AsyncClient(timeout=60.0) as client:
-            payload = {"name": name, "symbol": symbol, "description": description, "twitter_url": twitter_url, "telegram_url": telegram_url, "website_url": website_url}
-            response = await client.post(f"{TRADING_SERVICE_URL}/api/v1/pumpfun/create_token", json=payload)
-            response.raise_for_status()
-            data = response.json()
-            return f"Tạo token THÀNH CÔNG: {data}"
+        payload = {"name": name, "symbol": symbol, "description": description, "twitter_url": twitter_url, "telegram_url": telegram_url, "website_url": website_url}
+        response = await get_trading_client().post(
+            "/api/v1/pumpfun/create_token", json=payload, timeout=TOOL_TIMEOUTS["create_pumpfun_token_tool"]
+        )
+        response.raise_for_status()
+        data = response.json()
+        return f"Tạo token THÀNH CÔNG: {data}"
     except Exception as e:
         print(f"Lỗi khi gọi trading service (Create Token): {e}")
         return f"Lỗi: Không thể thực hiện tạo token. Lỗi: {e}"
@@ -119,12 +268,13 @@ async def execute_swap_tool(input_symbol: str, output_symbol: str, amount: float
     """
     print(f"AI Agent: Đang kích hoạt execute_swap_tool: {amount} {input_symbol} -> {output_symbol}")
     try:
-        async with httpx.AsyncClient(timeout=60.0) as client:
-            payload = {"input_symbol": input_symbol.upper(), "output_symbol": output_symbol.upper(), "amount": amount}
-            response = await client.post(f"{TRADING_SERVICE_URL}/api/v1/trade/execute", json=payload)
-            response.raise_for_status() 
-            data = response.json()
-            return f"Thực thi SWAP THÀNH CÔNG: {data}"
+        payload = {"input_symbol": input_symbol.upper(), "output_symbol": output_symbol.upper(), "amount": amount}
+        response = await get_trading_client().post(
+            "/api/v1/trade/execute", json=payload, timeout=TOOL_TIMEOUTS["execute_swap_tool"]
+        )
+        response.raise_for_status() 
+        data = response.json()
+        return f"Thực thi SWAP THÀNH CÔNG: {data}"
     except Exception as e:
         print(f"Lỗi khi gọi trading service (Execute Swap): {e}")
         return f"Lỗi: Không thể thực hiện swap. Lỗi: {e}"
@@ -138,7 +288,46 @@ crypto_tools = [
 ]
 
 # --- 4. Hàm create_agent (Không đổi) ---
+state_change_gates: dict[str, asyncio.Event] = {}  # tool_call_id -> đã chạy xong (để tool kế tiếp bắt đầu)
+
+def state_change_order(agent_action) -> list[str]:
+    """tool_call_id của các tool thay đổi trạng thái trong cùng 1 bước của model, đúng thứ tự model đưa ra."""
+    message_log = getattr(agent_action, "message_log", None) or []
+    tool_calls = getattr(message_log[-1], "tool_calls", None) if message_log else None
+    return [call["id"] for call in tool_calls or [] if call["name"] in STATE_CHANGING_TOOLS]
+
+@functools.cache
+def ordered_tool_executor_class():
+    from langchain.agents import AgentExecutor
+
+    class OrderedToolExecutor(AgentExecutor):
+        """
+        AgentExecutor (async) chạy mọi tool call của 1 bước song song bằng asyncio.gather.
+        Giữ nguyên điều đó cho tool chỉ đọc; tool thay đổi trạng thái (swap, tạo token) thì chạy
+        lần lượt, tool sau chỉ bắt đầu khi tool trước (theo thứ tự của model) đã xong.
+        """
+        async def _aperform_agent_action(self, name_to_tool_map, color_mapping, agent_action, run_manager=None):
+            order = state_change_order(agent_action)
+            call_id = getattr(agent_action, "tool_call_id", None)
+            if agent_action.tool not in STATE_CHANGING_TOOLS or call_id not in order:
+                return await super()._aperform_agent_action(name_to_tool_map, color_mapping, agent_action, run_manager)
+            index = order.index(call_id)
+            done = state_change_gates.setdefault(call_id, asyncio.Event())
+            if index > 0:
+                previous = state_change_gates.setdefault(order[index - 1], asyncio.Event())
+                await previous.wait()
+                state_change_gates.pop(order[index - 1], None)
+            try:
+                return await super()._aperform_agent_action(name_to_tool_map, color_mapping, agent_action, run_manager)
+            finally:
+                done.set()
+                if index == len(order) - 1:
+                    state_change_gates.pop(call_id, None)
+
+    return OrderedToolExecutor
+
 def create_agent(llm, tools: list, system_prompt: str):
+    from langchain.agents import create_tool_calling_agent
     tool_descriptions = render_text_description(tools)
     prompt_str = f"""
     {system_prompt}
@@ -153,27 +342,33 @@ def create_agent(llm, tools: list, system_prompt: str):
     """
     prompt = ChatPromptTemplate.from_template(prompt_str)
     agent = create_tool_calling_agent(llm, tools, prompt)
-    executor = AgentExecutor(agent=agent, tools=tools, verbose=True)
+    executor = ordered_tool_executor_class()(agent=agent, tools=tools, verbose=True, return_intermediate_steps=True)
     return executor
 
 # --- 5. Các Node (Không đổi) ---
 async def crypto_agent_node(state):
     print(">>> ĐANG GỌI CHUYÊN GIA CRYPTO")
-    # (Hàm này lấy 'chat_history' từ state, nên không cần sửa)
+    # Lịch sử được cắt theo ngân sách token của route (xem build_chat_context)
     last_message = state['messages'][-1]
     response = await crypto_agent_executor.ainvoke({
         "input": last_message.content,
-        "chat_history": state['messages'][:-1] 
+        "chat_history": build_chat_context(
+            state['messages'][:-1], state.get("summary", ""), "crypto_tools", state.get("verbatim_turns")
+        )
     })
-    return {"messages": [HumanMessage(content=response["output"], name="CryptoAgent")]}
+    # Ghi lại các tool đã dùng (để quyết định có cache câu trả lời hay không)
+    tools_used = [action.tool for action, _ in response.get("intermediate_steps", [])]
+    return {"messages": [HumanMessage(content=response["output"], name="CryptoAgent")], "tools_used": tools_used}
 
 async def general_agent_node(state):
     print(">>> ĐANG GỌI CHUYÊN GIA CHAT CHUNG")
-    # (Hàm này lấy 'chat_history' từ state, nên không cần sửa)
+    # Lịch sử được cắt theo ngân sách token của route (xem build_chat_context)
     last_message = state['messages'][-1]
     response = await general_agent_executor.ainvoke({
         "input": last_message.content,
-        "chat_history": state['messages'][:-1]
+        "chat_history": build_chat_context(
+            state['messages'][:-1], state.get("summary", ""), "general_chat", state.get("verbatim_turns")
+        )
     })
     return {"messages": [HumanMessage(content=response["output"], name="GeneralAgent")]}
 
@@ -191,8 +386,54 @@ class RouterSchema(LangchainBaseModel):
         )
     )
 
+# --- Bộ phân loại nhanh (không gọi LLM) ---
+# Chỉ trả kết quả khi chắc chắn; các trường hợp mơ hồ vẫn để LLM quyết định.
+# Không dùng "đồng" làm tín hiệu coin: trùng với VNĐ và các từ thường ("đồng hồ") -> để LLM quyết định
+COIN_PATTERN = re.compile(r"\b(sol|solana|usdc|usdt|bonk|wif|btc|eth|token|coin)\b")
+PRICE_PATTERN = re.compile(r"\b(giá|price|bao nhiêu)\b")
+TRADE_PATTERN = re.compile(r"\b(swap|mua|bán|buy|sell)\b")
+CREATE_TOKEN_PATTERN = re.compile(r"\b(tạo|create|launch|mint)\b.*\b(token|coin)\b")
+PUMPFUN_PATTERN = re.compile(r"pump\.?fun")
+MINT_ADDRESS_PATTERN = re.compile(r"\b[1-9A-HJ-NP-Za-km-z]{32,44}\b")
+GREETING_PATTERN = re.compile(
+    r"^(xin chào|chào|hello|hi|hey|alo|cảm ơn|cám ơn|thanks|thank you|bạn là ai|who are you|tạm biệt|bye)\b"
+)
+GREETING_MAX_WORDS = 8
+router_stats = {"fast_crypto_tools": 0, "fast_general_chat": 0, "llm": 0}
+
+def fast_route(prompt: str) -> str | None:
+    """Phân loại bằng luật (tiếng Việt + tiếng Anh). Trả None nếu không đủ chắc chắn."""
+    text = unicodedata.normalize("NFC", prompt).strip().lower()
+    has_coin = bool(COIN_PATTERN.search(text) or MINT_ADDRESS_PATTERN.search(prompt))
+    has_price = bool(PRICE_PATTERN.search(text))
+    has_trade = bool(TRADE_PATTERN.search(text))
+    has_create = bool(CREATE_TOKEN_PATTERN.search(text))
+    # Ý định giá / giao dịch chỉ tính khi có nhắc tới coin hoặc địa chỉ mint ("mua 2 cái bánh mì" không phải lệnh swap)
+    if (
+        PUMPFUN_PATTERN.search(text)
+        or MINT_ADDRESS_PATTERN.search(prompt)
+        or has_create
+        or (has_coin and (has_price or has_trade))
+    ):
+        return "crypto_tools"
+    # Chỉ coi là chào hỏi khi không có dấu hiệu nào của giá / giao dịch / tạo token ("hello, giá bitcoin" -> LLM quyết định)
+    if (
+        GREETING_PATTERN.search(text)
+        and not (has_coin or has_price or has_trade or has_create)
+        and len(text.split()) <= GREETING_MAX_WORDS
+    ):
+        return "general_chat"
+    return None
+
 async def router_node(state):
     print(">>> ĐANG GỌI MANAGER (ROUTER)")
+    destination = fast_route(state['messages'][-1].content)
+    if destination is not None:
+        router_stats[f"fast_{destination}"] += 1
+        print(f">>> QUYẾT ĐỊNH NHANH (không gọi LLM): {destination}")
+        return {"route": destination}
+
+    router_stats["llm"] += 1
     llm_with_tools = llm.with_structured_output(RouterSchema)
     prompt = f"""
     Bạn là một AI quản lý (Manager). Nhiệm vụ của bạn là phân loại câu hỏi của người dùng
@@ -202,142 +443,919 @@ async def router_node(state):
     - crypto_tools: Trả lời câu hỏi về giá, thông tin token, TẠO TOKEN, và THỰC THI SWAP.
     - general_chat: Trả lời câu hỏi chào hỏi, hỏi thăm (ví dụ: 'chào bạn', 'bạn là ai?').
     
-    Câu hỏi cuối cùng của người dùng (và lịch sử nếu có):
-    {state['messages']}
+    {router_view(state['messages'])}
     """
     route_decision = await llm_with_tools.ainvoke(prompt)
     print(f">>> QUYẾT ĐỊNH CỦA MANAGER: {route_decision.destination}")
     if route_decision.destination == "crypto_tools":
-        return "crypto_tools"
+        return {"route": "crypto_tools"}
     else:
-        return "general_chat"
+        return {"route": "general_chat"}
+
+def select_route(state) -> str:
+    """Cạnh điều kiện chỉ đọc quyết định router đã lưu trong state (không gọi LLM lần nữa)."""
+    return state["route"]
 
 # --- 6. Định nghĩa State và Graph (Không đổi) ---
 class AgentState(TypedDict):
     messages: Annotated[Sequence[BaseMessage], operator.add]
-llm = ChatOpenAI(model="gpt-4o-mini", temperature=0)
-crypto_agent_executor = create_agent(
-    llm, crypto_tools, 
-    "Bạn là chuyên gia Crypto, chuyên về Solana, Pump.fun, và có khả năng TẠO TOKEN cũng như THỰC HIỆN SWAP."
-)
-general_agent_executor = create_agent(
-    llm, [], 
-    "Bạn là một trợ lý AI thân thiện, trả lời các câu hỏi chung (không phải crypto)."
-)
-workflow = StateGraph(AgentState)
-workflow.add_node("router", router_node) 
-workflow.add_node("crypto_tools", crypto_agent_node) 
-workflow.add_node("general_chat", general_agent_node) 
-workflow.set_entry_point("router")
-workflow.add_conditional_edges("router", router_node, {"crypto_tools": "crypto_tools", "general_chat": "general_chat"})
-workflow.add_edge("crypto_tools", END)
-workflow.add_edge("general_chat", END)
-try:
+    route: str
+    tools_used: Annotated[list[str], operator.add]
+    summary: str  # tóm tắt cuốn chiếu các lượt chat cũ
+    verbatim_turns: int  # số lượt cần giữ nguyên văn (mọi lượt chưa được gộp vào tóm tắt)
+
+def build_agent_runtime():
+    """Import thư viện nặng, dựng LLM + 2 executor và biên dịch Graph (chạy trong thread, không chặn event loop)."""
+    global llm, crypto_agent_executor, general_agent_executor, graph_app
+    from langchain_openai import ChatOpenAI
+    from langgraph.graph import StateGraph, END
+
+    llm = ChatOpenAI(model="gpt-4o-mini", temperature=0)
+    crypto_agent_executor = create_agent(
+        llm, crypto_tools, 
+        "Bạn là chuyên gia Crypto, chuyên về Solana, Pump.fun, và có khả năng TẠO TOKEN cũng như THỰC HIỆN SWAP."
+    )
+    general_agent_executor = create_agent(
+        llm, [], 
+        "Bạn là một trợ lý AI thân thiện, trả lời các câu hỏi chung (không phải crypto)."
+    )
+    workflow = StateGraph(AgentState)
+    workflow.add_node("router", router_node) 
+    workflow.add_node("crypto_tools", crypto_agent_node) 
+    workflow.add_node("general_chat", general_agent_node) 
+    workflow.set_entry_point("router")
+    workflow.add_conditional_edges("router", select_route, {"crypto_tools": "crypto_tools", "general_chat": "general_chat"})
+    workflow.add_edge("crypto_tools", END)
+    workflow.add_edge("general_chat", END)
     graph_app = workflow.compile()
     print("Đã biên dịch Graph (Manager-Agent) thành công!")
-except Exception as e:
-    print(f"Lỗi khi biên dịch Graph: {e}")
+
+async def init_agent_runtime():
+    started = time.perf_counter()
+    try:
+        await asyncio.to_thread(build_agent_runtime)
+        readiness["agent_runtime"] = True
+        readiness["error"] = None
+    except Exception as e:
+        readiness["error"] = f"{type(e).__name__}: {e}"
+        print(f"Lỗi khi dựng Graph (Bộ não AI): {e}")
+    readiness["runtime_init_seconds"] = round(time.perf_counter() - started, 3)
+
+async def ensure_agent_runtime():
+    """Single-flight: mọi request chờ chung 1 lần dựng Graph; lần dựng lỗi thì request sau thử lại."""
+    global agent_runtime_task
+    if graph_app is not None:
+        return
+    if agent_runtime_task is None or (agent_runtime_task.done() and graph_app is None):
+        agent_runtime_task = asyncio.create_task(init_agent_runtime())
+    await asyncio.shield(agent_runtime_task)
 
 # --- 7. FastAPI Startup (Không đổi) ---
 app = FastAPI(title="AI Agent Service (Manager-Agent Architecture)")
+background_tasks: list[asyncio.Task] = []
 @app.on_event("startup")
-def startup_app():
-    global db
-    try:
-        client = MongoClient(MONGO_URI)
-        db = client["crypto_ai_platform"]
-        print("Đã kết nối thành công đến MongoDB!")
-    except Exception as e:
-        print(f"Lỗi khi kết nối MongoDB: {e}")
+async def startup_app():
+    global db, mongo_client, trading_http_client, redis_client, chat_write_queue, chat_writer_task, run_semaphore
+    global summary_semaphore
+    # Tạo client ngay (không kết nối); kết nối thật + dựng Graph chạy nền -> process nhận liveness probe ngay
+    mongo_client = AsyncMongoClient(MONGO_URI, serverSelectionTimeoutMS=5000, tz_aware=True)
+    db = mongo_client["crypto_ai_platform"]
+    trading_http_client = httpx.AsyncClient(
+        base_url=TRADING_SERVICE_URL, limits=TRADING_HTTP_LIMITS, timeout=10.0
+    )
+    print("Đã khởi tạo HTTP Client dùng chung (trading-service).")
+    redis_client = aioredis.Redis(host=REDIS_HOST, port=6379, db=0, decode_responses=True)
+    chat_write_queue = asyncio.Queue(maxsize=CHAT_WRITE_QUEUE_SIZE)
+    run_semaphore = asyncio.Semaphore(ADMISSION_MAX_CONCURRENT)
+    summary_semaphore = asyncio.Semaphore(SUMMARY_MAX_CONCURRENT)
+    chat_writer_task = asyncio.create_task(chat_writer_loop())
     if not OPENAI_API_KEY:
         print("LỖI: OPENAI_API_KEY chưa được thiết lập!")
+    background_tasks.append(asyncio.create_task(warmup()))
+
+async def warm_mongo():
+    """Ping (mở pool kết nối) + tạo index, thử lại tới khi thành công; chỉ khi xong mới báo ready."""
+    delay = 1.0
+    while True:
+        try:
+            await mongo_client.admin.command("ping")
+            # Index phục vụ truy vấn lịch sử theo user, mới nhất trước (_id để phân trang keyset ổn định)
+            await db.chat_history.create_index(
+                [("user_id", ASCENDING), ("timestamp", DESCENDING), ("_id", DESCENDING)], name="user_id_timestamp_id"
+            )
+            await db.chat_history.create_index(
+                [("timestamp", DESCENDING), ("_id", DESCENDING)], name="timestamp_id"
+            )
+            await db.chat_summaries.create_index([("user_id", ASCENDING)], name="user_id", unique=True)
+            readiness["mongo"] = True
+            print("Đã kết nối thành công đến MongoDB!")
+            return
+        except Exception as e:
+            print(f"Lỗi khi kết nối MongoDB (thử lại sau {delay:.0f}s): {e}")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 30.0)
+
+async def warm_http_pool():
+    """Mở sẵn vài kết nối keep-alive tới trading-service (không bắt buộc cho readiness: chat chung vẫn chạy được)."""
+    try:
+        await asyncio.gather(*(
+            trading_http_client.get("/metrics", timeout=5.0) for _ in range(TRADING_HTTP_WARM_CONNECTIONS)
+        ))
+        readiness["http_warm"] = True
+    except Exception as e:
+        print(f"Không làm nóng được kết nối tới trading-service: {e}")
+
+async def warm_tokenizer():
+    """
+    Nạp tokenizer tiktoken trong thread (lần đầu phải tải file BPE qua mạng, không được chặn event loop).
+    Lỗi mạng -> thử lại với backoff; trong lúc chờ count_tokens dùng ước lượng. Không bắt buộc cho readiness.
+    """
+    global token_encoding
+    try:
+        import tiktoken
+    except ImportError:
+        print("Chưa cài tiktoken, dùng ước lượng số token (~4 ký tự / token).")
         return
-    if graph_app is None:
-        print("LỖI: Graph (Bộ não AI) chưa được biên dịch!")
+    delay = 5.0
+    while True:
+        try:
+            # tokenizer của gpt-4o / gpt-4o-mini
+            token_encoding = await asyncio.to_thread(tiktoken.get_encoding, "o200k_base")
+            readiness["tokenizer"] = True
+            return
+        except Exception as e:
+            print(f"Không nạp được tiktoken (thử lại sau {delay:.0f}s), tạm ước lượng số token: {e}")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 300.0)
+
+async def warmup():
+    started = time.perf_counter()
+    background_tasks.append(asyncio.create_task(warm_tokenizer()))
+    await asyncio.gather(warm_mongo(), warm_http_pool(), ensure_agent_runtime())
+    if is_ready():
+        print(f"AI Agent Service (Manager-Agent) đã sẵn sàng! (warmup {time.perf_counter() - started:.2f}s)")
     else:
-        print("AI Agent Service (Manager-Agent) đã sẵn sàng!")
+        print(f"AI Agent Service CHƯA sẵn sàng: {readiness}")
+
+def is_ready() -> bool:
+    return readiness["agent_runtime"] and readiness["mongo"]
+
+# Liveness: process còn sống (không phụ thuộc Mongo / OpenAI) -> orchestrator không restart nhầm lúc warmup
+@app.get("/health/live")
+async def liveness():
+    return {"status": "alive"}
+
+# Readiness: chỉ nhận traffic khi Graph đã dựng xong và MongoDB đã kết nối
+@app.get("/health/ready")
+async def readiness_probe(response: Response):
+    ready = is_ready()
+    if not ready:
+        response.status_code = 503
+    return {"status": "ready" if ready else "starting", **readiness}
+
+@app.on_event("shutdown")
+async def shutdown_app():
+    for task in background_tasks:
+        task.cancel()
+    await stop_chat_writer()
+    for task in summary_tasks.values():
+        task.cancel()
+    if trading_http_client is not None:
+        await trading_http_client.aclose()
+        print("Đã đóng HTTP Client (trading-service).")
+    if redis_client is not None:
+        await redis_client.aclose()
 
 # --- 8. CORS (Không đổi) ---
 origins = ["http://localhost:3000"]
 app.add_middleware(CORSMiddleware, allow_origins=origins, allow_credentials=True, allow_methods=["*"], allow_headers=["*"])
 
+@app.get("/api/v1/agent/router/stats")
+async def get_router_stats():
+    fast = router_stats["fast_crypto_tools"] + router_stats["fast_general_chat"]
+    total = fast + router_stats["llm"]
+    return {**router_stats, "fast_path_ratio": round(fast / total, 4) if total else None}
+
+# --- Cache câu trả lời (Redis) ---
+# Key = route + prompt đã chuẩn hóa + hash của TOÀN BỘ bối cảnh đưa vào agent (mọi lượt đã tải + tóm tắt),
+# để 2 user chỉ trùng vài lượt cuối không dùng chung câu trả lời có nội dung cũ của nhau.
+# TTL theo loại câu trả lời; lượt có tool thay đổi trạng thái (swap, tạo token) KHÔNG BAO GIỜ được cache.
+RESPONSE_CACHE_TTLS = {
+    "price": int(os.getenv("RESPONSE_CACHE_PRICE_TTL", "5")),        # đã dùng tool lấy giá
+    "crypto_tools": int(os.getenv("RESPONSE_CACHE_CRYPTO_TTL", "60")),  # tool chỉ đọc (thông tin token)
+    "general_chat": int(os.getenv("RESPONSE_CACHE_GENERAL_TTL", "600")),
+}
+PRICE_TOOLS = {"get_sol_price"}
+STATE_CHANGING_TOOLS = {"execute_swap_tool", "create_pumpfun_token_tool"}
+response_cache_stats = {"hits": 0, "misses": 0, "bypassed": 0, "stored": 0}
+
+def normalize_prompt(prompt: str) -> str:
+    text = unicodedata.normalize("NFC", prompt).lower()
+    return " ".join(text.split()).strip(" ?!.")
+
+def is_state_changing_intent(prompt: str) -> bool:
+    """Câu hỏi có ý định swap / tạo token: bỏ qua cache cả khi đọc lẫn ghi."""
+    text = unicodedata.normalize("NFC", prompt).lower()
+    return bool(TRADE_PATTERN.search(text) or CREATE_TOKEN_PATTERN.search(text))
+
+def response_cache_key(route: str, prompt: str, history_records: list[dict], summary: str) -> str:
+    context = {"summary": summary, "turns": [[r["prompt"], r["response"]] for r in history_records]}
+    history_hash = hashlib.sha256(json.dumps(context, ensure_ascii=False).encode()).hexdigest()[:32]
+    prompt_hash = hashlib.sha256(normalize_prompt(prompt).encode()).hexdigest()[:32]
+    return f"agent:resp:{route}:{prompt_hash}:{history_hash}"
+
+def route_cache_key(prompt: str) -> str:
+    return f"agent:route:{hashlib.sha256(normalize_prompt(prompt).encode()).hexdigest()[:32]}"
+
+async def lookup_cached_route(prompt: str) -> str | None:
+    """Route của prompt: luật nhanh trước, sau đó route LLM đã quyết định lần trước (nếu có)."""
+    route = fast_route(prompt)
+    if route is None and redis_client is not None:
+        route = await redis_client.get(route_cache_key(prompt))
+    return route
+
+def response_cache_ttl(route: str, tools_used: list[str]) -> int | None:
+    """TTL cho lượt chat; None = không được cache."""
+    if STATE_CHANGING_TOOLS.intersection(tools_used):
+        return None
+    if PRICE_TOOLS.intersection(tools_used):
+        return RESPONSE_CACHE_TTLS["price"]
+    return RESPONSE_CACHE_TTLS.get(route)
+
+async def get_cached_response(prompt: str, history_records: list[dict], summary: str) -> str | None:
+    if redis_client is None or is_state_changing_intent(prompt):
+        response_cache_stats["bypassed"] += 1
+        return None
+    try:
+        route = await lookup_cached_route(prompt)
+        cached = await redis_client.get(response_cache_key(route, prompt, history_records, summary)) if route else None
+    except Exception as e:
+        print(f"Lỗi khi đọc cache câu trả lời: {e}")
+        return None
+    response_cache_stats["hits" if cached is not None else "misses"] += 1
+    return cached
+
+async def store_cached_response(prompt: str, history_records: list[dict], summary: str, route: str | None,
+                                tools_used: list[str], response_text: str):
+    if redis_client is None or route is None or is_state_changing_intent(prompt):
+        return
+    ttl = response_cache_ttl(route, tools_used)
+    if not ttl:
+        return
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.set(response_cache_key(route, prompt, history_records, summary), response_text, ex=ttl)
+        pipe.set(route_cache_key(prompt), route, ex=RESPONSE_CACHE_TTLS["general_chat"])
+        await pipe.execute()
+        response_cache_stats["stored"] += 1
+    except Exception as e:
+        print(f"Lỗi khi ghi cache câu trả lời: {e}")
+
+@app.get("/api/v1/agent/cache/stats")
+async def get_response_cache_stats():
+    lookups = response_cache_stats["hits"] + response_cache_stats["misses"]
+    return {
+        **response_cache_stats,
+        "hit_ratio": round(response_cache_stats["hits"] / lookups, 4) if lookups else None,
+        "tool_memo": {**tool_memo_stats, "entries": len(tool_memo)},
+    }
+
 class ChatPrompt(BaseModel):
     user_id: str
     prompt: str
 
+# --- 8b. Kiểm soát tải (admission control) ---
+# Request vượt giới hạn bị từ chối NGAY bằng 429 + Retry-After thay vì dồn thêm tải lên OpenAI / trading-service.
+RUNS_IN_FLIGHT = Gauge("agent_runs_in_flight", "Số lượt chat (Graph) đang chạy")
+RUNS_WAITING = Gauge("agent_admission_queue_depth", "Số lượt chat đang chờ trong hàng đợi")
+ADMISSION_REJECTED = Counter("agent_admission_rejected_total", "Số request bị từ chối (429)", ["reason"])
+CHATS_COALESCED = Counter("agent_chats_coalesced_total", "Số request trùng prompt được gộp vào lượt đang chạy")
+RUNS_IN_FLIGHT.set_function(lambda: runs_in_flight)
+RUNS_WAITING.set_function(lambda: runs_waiting)
+
+def retry_after_seconds() -> int:
+    """Ước lượng thời gian hàng đợi rút bớt: (số lượt đang chờ + 1) / số slot * thời gian trung bình 1 lượt."""
+    estimate = run_seconds_avg * (runs_waiting + 1) / ADMISSION_MAX_CONCURRENT
+    return max(1, min(60, math.ceil(estimate)))
+
+def reject_run(reason: str, detail: str):
+    ADMISSION_REJECTED.labels(reason).inc()
+    raise HTTPException(status_code=429, detail=detail, headers={"Retry-After": str(retry_after_seconds())})
+
+def release_user_run(user_id: str):
+    remaining = user_runs.get(user_id, 0) - 1
+    if remaining > 0:
+        user_runs[user_id] = remaining
+    else:
+        user_runs.pop(user_id, None)
+
+async def acquire_run_slot(user_id: str):
+    """Chiếm 1 slot chạy Graph; raise HTTPException 429 nếu user vượt giới hạn, hàng đợi đầy hoặc chờ quá hạn."""
+    global runs_waiting, runs_in_flight
+    if user_runs.get(user_id, 0) >= ADMISSION_MAX_PER_USER:
+        reject_run("per_user", "Bạn đang có quá nhiều yêu cầu chưa xử lý xong, vui lòng thử lại sau.")
+    if runs_in_flight + runs_waiting >= ADMISSION_MAX_CONCURRENT + ADMISSION_QUEUE_SIZE:
+        reject_run("queue_full", "Hệ thống đang quá tải, vui lòng thử lại sau.")
+    user_runs[user_id] = user_runs.get(user_id, 0) + 1
+    runs_waiting += 1
+    try:
+        await asyncio.wait_for(run_semaphore.acquire(), timeout=ADMISSION_QUEUE_TIMEOUT)
+    except asyncio.TimeoutError:
+        release_user_run(user_id)
+        reject_run("deadline", "Hệ thống đang quá tải (chờ quá lâu), vui lòng thử lại sau.")
+    except BaseException:
+        release_user_run(user_id)
+        raise
+    finally:
+        runs_waiting -= 1
+    runs_in_flight += 1
+
+def release_run_slot(user_id: str, elapsed: float):
+    global runs_in_flight, run_seconds_avg
+    runs_in_flight -= 1
+    run_semaphore.release()
+    release_user_run(user_id)
+    run_seconds_avg = 0.9 * run_seconds_avg + 0.1 * elapsed
+
+@app.get("/api/v1/agent/admission/stats")
+async def get_admission_stats():
+    return {
+        "runs_in_flight": runs_in_flight,
+        "queue_depth": runs_waiting,
+        "coalesced_in_flight": len(inflight_chats),
+        "active_users": len(user_runs),
+        "run_seconds_avg": round(run_seconds_avg, 3),
+        "limits": {
+            "max_concurrent": ADMISSION_MAX_CONCURRENT,
+            "max_per_user": ADMISSION_MAX_PER_USER,
+            "queue_size": ADMISSION_QUEUE_SIZE,
+            "queue_timeout": ADMISSION_QUEUE_TIMEOUT,
+        },
+    }
+
+@app.get("/metrics")
+async def metrics():
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
 # --- 9. Endpoint (THAY ĐỔI: TẢI LỊCH SỬ CHAT TỪ DB) ---
-@app.post("/api/v1/agent/chat")
-async def handle_chat(payload: ChatPrompt):
-    print(f"Graph nhận prompt: {payload.prompt} từ user: {payload.user_id}")
-    
-    if graph_app is None or db is None:
-        return {"user_id": payload.user_id, "response": "LỖI: AI Graph hoặc CSDL chưa được khởi tạo."}
+def get_cached_history(user_id: str) -> list[dict] | None:
+    entry = history_cache.get(user_id)
+    if entry is None:
+        return None
+    loaded_at, records = entry
+    if time.monotonic() - loaded_at > HISTORY_CACHE_TTL:
+        del history_cache[user_id]
+        return None
+    history_cache.move_to_end(user_id)
+    return list(records)
+
+def put_cached_history(user_id: str, records_oldest_first: list[dict]):
+    history_cache[user_id] = (time.monotonic(), deque(records_oldest_first, maxlen=HISTORY_LIMIT))
+    history_cache.move_to_end(user_id)
+    while len(history_cache) > HISTORY_CACHE_USERS:
+        evicted_user, _ = history_cache.popitem(last=False)
+        summary_cache.pop(evicted_user, None)
 
+async def load_chat_history(user_id: str) -> tuple[list, list[dict]]:
+    """-> (Langchain messages theo thứ tự cũ -> mới, DB records mới -> cũ)."""
     # --- ĐÂY LÀ LOGIC THÊM TRÍ NHỚ ---
     chat_history_messages = []
+    db_records = []
     try:
-        # 1. Lấy 10 tin nhắn gần nhất (5 cặp hỏi-đáp)
-        history_cursor = db.chat_history.find(
-            {"user_id": payload.user_id}
-        ).sort("timestamp", -1).limit(10)
-        
-        # 2. Chuyển đổi DB records -> Langchain Messages
-        # (Lưu ý: Phải lặp ngược `reversed` để đưa tin nhắn cũ nhất vào trước)
-        db_records = list(history_cursor)
-        for doc in reversed(db_records):
+        records = get_cached_history(user_id)
+        if records is None:
+            # 1. Lấy 10 tin nhắn gần nhất (5 cặp hỏi-đáp) - dùng index (user_id, timestamp)
+            history_cursor = db.chat_history.find(
+                {"user_id": user_id}, HISTORY_PROJECTION
+            ).sort("timestamp", -1).limit(HISTORY_LIMIT)
+            records = list(reversed(await history_cursor.to_list(HISTORY_LIMIT)))
+            put_cached_history(user_id, records)
+
+        # 2. Chuyển đổi DB records -> Langchain Messages (cũ nhất trước)
+        for doc in records:
             chat_history_messages.append(HumanMessage(content=doc["prompt"]))
             chat_history_messages.append(AIMessage(content=doc["response"]))
+        db_records = list(reversed(records))
         
         print(f" - Đã tải {len(chat_history_messages)} tin nhắn từ lịch sử.")
 
     except Exception as e:
         print(f"Lỗi khi tải lịch sử chat từ MongoDB: {e}")
         # Không làm gián đoạn, tiếp tục với lịch sử rỗng
+    return chat_history_messages, db_records
+
+async def save_chat_record(user_id: str, prompt: str, response_text: str):
+    """
+    Đưa bản ghi vào hàng đợi write-behind (không chờ MongoDB).
+    Hàng đợi đầy (Mongo chậm) -> request chờ tối đa CHAT_WRITE_ENQUEUE_TIMEOUT (backpressure),
+    quá hạn thì ghi trực tiếp để không mất dữ liệu.
+    """
+    if db is None:
+        return
+    chat_record = {
+        "user_id": user_id,
+        "prompt": prompt, # Câu hỏi của người dùng
+        "response": response_text, # Câu trả lời của AI
+        "timestamp": datetime.datetime.now(datetime.timezone.utc)
+    }
+    # Cập nhật ring buffer ngay để lượt chat kế tiếp thấy được câu trả lời này
+    entry = history_cache.get(user_id)
+    if entry is not None:
+        entry[1].append({k: chat_record[k] for k in ("prompt", "response", "timestamp")})
+
+    if chat_write_queue is not None and chat_writer_task is not None and not chat_writer_task.done():
+        try:
+            await asyncio.wait_for(chat_write_queue.put(chat_record), timeout=CHAT_WRITE_ENQUEUE_TIMEOUT)
+            chat_writer_stats["enqueued"] += 1
+            return
+        except asyncio.TimeoutError:
+            print("Hàng đợi ghi chat đầy, ghi trực tiếp vào MongoDB.")
+    try:
+        await db.chat_history.insert_one(chat_record)
+        chat_writer_stats["direct_writes"] += 1
+    except Exception as e:
+        print(f"Lỗi khi lưu vào MongoDB: {e}")
+
+DUPLICATE_KEY_ERROR = 11000
+
+async def flush_chat_batch(batch: list[dict]):
+    # Gán _id 1 lần trước lần thử đầu: bản ghi đã vào DB (lỗi từng phần, hoặc lỗi mạng sau khi server
+    # đã ghi) sẽ báo trùng khóa ở lần thử lại thay vì bị ghi thêm 1 bản
+    for record in batch:
+        record.setdefault("_id", ObjectId())
+    remaining = batch
+    for attempt in range(1, CHAT_WRITE_MAX_RETRIES + 1):
+        try:
+            await db.chat_history.insert_many(remaining, ordered=False)
+            chat_writer_stats["written"] += len(remaining)
+            chat_writer_stats["batches"] += 1
+            return
+        except BulkWriteError as e:
+            # Chỉ thử lại các bản ghi lỗi thật; lỗi trùng khóa = bản ghi đã có trong DB
+            errors = e.details.get("writeErrors", [])
+            failed = {err["index"] for err in errors if err.get("code") != DUPLICATE_KEY_ERROR}
+            chat_writer_stats["written"] += len(remaining) - len(failed)
+            remaining = [record for index, record in enumerate(remaining) if index in failed]
+            if not remaining:
+                chat_writer_stats["batches"] += 1
+                return
+            print(f"Lỗi insert_many ({attempt}/{CHAT_WRITE_MAX_RETRIES}): {len(remaining)} bản ghi lỗi")
+        except Exception as e:
+            print(f"Lỗi insert_many ({attempt}/{CHAT_WRITE_MAX_RETRIES}): {e}")
+        await asyncio.sleep(0.5 * 2 ** (attempt - 1))
+    chat_writer_stats["dropped"] += len(remaining)
+    print(f"Bỏ {len(remaining)} bản ghi chat sau {CHAT_WRITE_MAX_RETRIES} lần thử.")
+
+async def chat_writer_loop():
+    """Gom bản ghi: flush khi đủ CHAT_WRITE_BATCH_SIZE hoặc sau CHAT_WRITE_FLUSH_INTERVAL giây. None = dừng."""
+    print("Đã khởi động bộ ghi chat (write-behind).")
+    while True:
+        record = await chat_write_queue.get()
+        if record is None:
+            return
+        batch = [record]
+        stopping = False
+        deadline = time.monotonic() + CHAT_WRITE_FLUSH_INTERVAL
+        while len(batch) < CHAT_WRITE_BATCH_SIZE:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                record = await asyncio.wait_for(chat_write_queue.get(), timeout=remaining)
+            except asyncio.TimeoutError:
+                break
+            if record is None:
+                stopping = True
+                break
+            batch.append(record)
+        # Trong lúc flush, hàng đợi có thể đầy -> request mới sẽ chờ (backpressure)
+        await flush_chat_batch(batch)
+        if stopping:
+            return
+
+async def stop_chat_writer():
+    """Lúc shutdown: báo dừng, chờ task nền ghi xong batch hiện tại, rồi ghi nốt phần còn lại."""
+    if chat_writer_task is None:
+        return
+    if not chat_writer_task.done():
+        await chat_write_queue.put(None)
+        try:
+            await asyncio.wait_for(chat_writer_task, timeout=30)
+        except asyncio.TimeoutError:
+            print("Bộ ghi chat không dừng kịp.")
+    pending = []
+    while not chat_write_queue.empty():
+        record = chat_write_queue.get_nowait()
+        if record is not None:
+            pending.append(record)
+    for i in range(0, len(pending), CHAT_WRITE_BATCH_SIZE):
+        await flush_chat_batch(pending[i:i + CHAT_WRITE_BATCH_SIZE])
+    print(f"Đã dừng bộ ghi chat (flush thêm {len(pending)} bản ghi).")
+
+@app.get("/api/v1/agent/persistence/stats")
+async def get_persistence_stats():
+    return {**chat_writer_stats, "queue_depth": chat_write_queue.qsize() if chat_write_queue else 0}
+
+# --- 9a. Bối cảnh hội thoại: ngân sách token + tóm tắt cuốn chiếu ---
+def get_token_encoding():
+    """Tokenizer của OpenAI (nạp nền bởi warm_tokenizer). None khi chưa nạp xong -> ước lượng ~4 ký tự / token."""
+    return token_encoding
+
+def count_tokens(text: str) -> int:
+    encoding = get_token_encoding()
+    if encoding is None:
+        return len(text) // 4 + 1
+    return len(encoding.encode(text, disallowed_special=()))
+
+def truncate_tokens(text: str, max_tokens: int) -> str:
+    encoding = get_token_encoding()
+    if encoding is None:
+        return text if len(text) <= max_tokens * 4 else text[:max_tokens * 4] + " …"
+    tokens = encoding.encode(text, disallowed_special=())
+    return text if len(tokens) <= max_tokens else encoding.decode(tokens[:max_tokens]) + " …"
+
+def format_message(message: BaseMessage, max_tokens: int) -> str:
+    speaker = "Người dùng" if isinstance(message, HumanMessage) and not message.name else "AI"
+    return f"{speaker}: {truncate_tokens(message.content, max_tokens)}"
+
+def build_chat_context(history: Sequence[BaseMessage], summary: str, route: str,
+                       verbatim_turns: int | None = None) -> str:
+    """
+    Lịch sử cho agent dạng text gọn, không vượt CONTEXT_TOKEN_BUDGETS[route]:
+    tóm tắt (nếu có) + các tin nhắn gần nhất (mới nhất được ưu tiên), mỗi tin bị cắt ở CONTEXT_MESSAGE_MAX_TOKENS.
+    verbatim_turns: số lượt giữ nguyên văn (mặc định CONTEXT_RECENT_TURNS); lượt chưa được tóm tắt không bị bỏ,
+    trừ khi vượt ngân sách token (tính vào dropped_turns).
+    """
+    budget = CONTEXT_TOKEN_BUDGETS.get(route, CONTEXT_TOKEN_BUDGETS["general_chat"])
+    header = f"Tóm tắt hội thoại trước đó: {summary}" if summary else ""
+    used = count_tokens(header) if header else 0
+    recent = list(history)[-2 * max(CONTEXT_RECENT_TURNS, verbatim_turns or 0):]
+    lines = []
+    for index, message in enumerate(reversed(recent)):
+        line = format_message(message, CONTEXT_MESSAGE_MAX_TOKENS)
+        cost = count_tokens(line)
+        if used + cost > budget:
+            context_stats["dropped_turns"] += (len(recent) - index + 1) // 2
+            break
+        lines.append(line)
+        used += cost
+    lines.reverse()
+    return "\n".join([header, *lines] if header else lines)
+
+def router_view(messages: Sequence[BaseMessage]) -> str:
+    """Router chỉ cần câu hỏi mới + câu hỏi liền trước (để hiểu câu hỏi nối tiếp), không cần toàn bộ lịch sử."""
+    previous = [m for m in messages[:-1] if isinstance(m, HumanMessage) and not m.name]
+    view = ""
+    if previous:
+        view += f"Câu hỏi trước đó: {truncate_tokens(previous[-1].content, ROUTER_CONTEXT_TOKENS)}\n"
+    return view + f"Câu hỏi cuối cùng của người dùng: {messages[-1].content}"
+
+def unsummarized_turns(db_records: list[dict], covered_until) -> int:
+    """Số lượt đã tải (mới -> cũ) chưa được gộp vào tóm tắt: các lượt này phải được giữ nguyên văn."""
+    if covered_until is None:
+        return len(db_records)
+    return sum(1 for r in db_records if r.get("timestamp") is None or r["timestamp"] > covered_until)
+
+async def load_conversation_summary(user_id: str) -> dict:
+    """-> {"summary", "covered_until"} (covered_until = timestamp của lượt mới nhất đã được gộp vào tóm tắt)."""
+    state = summary_cache.get(user_id)
+    if state is None:
+        state = {"summary": "", "covered_until": None}
+        try:
+            doc = await db.chat_summaries.find_one(
+                {"user_id": user_id}, {"_id": 0, "summary": 1, "covered_until": 1}
+            )
+            if doc:
+                state = {"summary": doc.get("summary", ""), "covered_until": doc.get("covered_until")}
+        except Exception as e:
+            print(f"Lỗi khi tải tóm tắt hội thoại: {e}")
+        summary_cache[user_id] = state
+    return state
+
+async def update_conversation_summary(user_id: str):
+    """
+    Gộp các lượt đã rời khỏi cửa sổ nguyên văn (và chưa được tóm tắt) vào bản tóm tắt hiện có.
+    Chưa đủ SUMMARY_MIN_PENDING_TURNS lượt -> để dồn tiếp; lần gọi LLM chạy dưới summary_semaphore.
+    """
+    records = get_cached_history(user_id)  # cũ -> mới
+    if not records:
+        return
+    state = await load_conversation_summary(user_id)
+    covered_until = state["covered_until"]
+    pending = [
+        r for r in records[:-CONTEXT_RECENT_TURNS]
+        if covered_until is None or r["timestamp"] > covered_until
+    ]
+    if len(pending) < SUMMARY_MIN_PENDING_TURNS:
+        if pending:
+            context_stats["summary_deferred"] += 1
+        return
+    turns = "\n".join(
+        f"Người dùng: {truncate_tokens(r['prompt'], CONTEXT_MESSAGE_MAX_TOKENS)}\n"
+        f"AI: {truncate_tokens(r['response'], CONTEXT_MESSAGE_MAX_TOKENS)}"
+        for r in pending
+    )
+    prompt = f"""
+    Cập nhật bản tóm tắt hội thoại giữa người dùng và trợ lý crypto.
+    Giữ lại: thông tin về người dùng, token / địa chỉ contract đã nhắc đến, giao dịch đã thực hiện, yêu cầu còn dang dở.
+    Viết ngắn gọn (tối đa khoảng {SUMMARY_MAX_TOKENS} token), chỉ trả về bản tóm tắt.
+
+    Tóm tắt hiện tại:
+    {state["summary"] or "(chưa có)"}
+
+    Các lượt chat mới cần gộp vào:
+    {turns}
+    """
+    if llm is None or summary_semaphore is None:
+        return
+    try:
+        async with summary_semaphore:
+            result = await llm.ainvoke(prompt)
+        new_state = {
+            "summary": truncate_tokens(result.content.strip(), SUMMARY_MAX_TOKENS),
+            "covered_until": pending[-1]["timestamp"],
+        }
+        await db.chat_summaries.update_one(
+            {"user_id": user_id},
+            {"$set": {**new_state, "updated_at": datetime.datetime.now(datetime.timezone.utc)}},
+            upsert=True,
+        )
+        summary_cache[user_id] = new_state
+        context_stats["summary_updates"] += 1
+    except Exception as e:
+        context_stats["summary_errors"] += 1
+        print(f"Lỗi khi cập nhật tóm tắt hội thoại: {e}")
+
+def schedule_summary_update(user_id: str):
+    """Chạy nền sau khi trả lời (không làm chậm request). Đang có lần cập nhật khác -> để lượt sau gộp tiếp."""
+    if db is None:
+        return
+    task = summary_tasks.get(user_id)
+    if task is not None and not task.done():
+        context_stats["summary_skipped_busy"] += 1
+        return
+    task = asyncio.create_task(update_conversation_summary(user_id))
+    summary_tasks[user_id] = task
+    task.add_done_callback(lambda t: summary_tasks.pop(user_id, None) if summary_tasks.get(user_id) is t else None)
+
+@app.get("/api/v1/agent/context/stats")
+async def get_context_stats():
+    return {**context_stats, "budgets": CONTEXT_TOKEN_BUDGETS, "summaries_in_progress": len(summary_tasks)}
+
+@app.post("/api/v1/agent/chat")
+async def handle_chat(payload: ChatPrompt):
+    print(f"Graph nhận prompt: {payload.prompt} từ user: {payload.user_id}")
+    await ensure_agent_runtime()
+    
+    if graph_app is None or db is None:
+        return {"user_id": payload.user_id, "response": "LỖI: AI Graph hoặc CSDL chưa được khởi tạo."}
+
+    # Cùng user gửi lại đúng prompt đang xử lý (double-click, retry) -> dùng chung kết quả, không chạy Graph lần 2
+    key = (payload.user_id, normalize_prompt(payload.prompt))
+    task = inflight_chats.get(key)
+    if task is not None:
+        CHATS_COALESCED.inc()
+        return await asyncio.shield(task)
+
+    # shield: client ngắt kết nối không hủy lượt chat (các request đã gộp vào vẫn nhận được kết quả)
+    task = asyncio.create_task(admitted_chat_turn(payload))
+    inflight_chats[key] = task
+    task.add_done_callback(lambda t: inflight_chats.pop(key, None) if inflight_chats.get(key) is t else None)
+    return await asyncio.shield(task)
+
+async def admitted_chat_turn(payload: ChatPrompt) -> dict:
+    await acquire_run_slot(payload.user_id)
+    started = time.monotonic()
+    try:
+        return await run_chat_turn(payload)
+    finally:
+        release_run_slot(payload.user_id, time.monotonic() - started)
+
+async def run_chat_turn(payload: ChatPrompt) -> dict:
+    (chat_history_messages, db_records), summary_state = await asyncio.gather(
+        load_chat_history(payload.user_id), load_conversation_summary(payload.user_id)
+    )
 
     # 3. Thêm tin nhắn MỚI của người dùng vào cuối
     chat_history_messages.append(HumanMessage(content=payload.prompt))
     
-    # 4. Tạo input cho Graph
-    inputs = {"messages": chat_history_messages}
+    # 4. Tạo input cho Graph (các node tự cắt lịch sử theo ngân sách token của route)
+    inputs = {
+        "messages": chat_history_messages,
+        "summary": summary_state["summary"],
+        "verbatim_turns": unsummarized_turns(db_records, summary_state["covered_until"]),
+    }
     # --- KẾT THÚC LOGIC TRÍ NHỚ ---
 
-    try:
-        # Gọi Graph với đầy đủ lịch sử
-        response = await graph_app.ainvoke(inputs)
-        
-        # Lấy tin nhắn cuối cùng (là câu trả lời của AI)
-        response_text = response["messages"][-1].content
+    # Câu hỏi lặp lại (cùng bối cảnh) -> trả từ cache, không chạy Graph / gọi OpenAI
+    response_text = await get_cached_response(payload.prompt, db_records, summary_state["summary"])
+    cached = response_text is not None
+
+    if not cached:
+        try:
+            # Gọi Graph với đầy đủ lịch sử
+            response = await graph_app.ainvoke(inputs)
+            
+            # Lấy tin nhắn cuối cùng (là câu trả lời của AI)
+            response_text = response["messages"][-1].content
+            await store_cached_response(
+                payload.prompt, db_records, summary_state["summary"],
+                response.get("route"), response.get("tools_used", []), response_text,
+            )
 
+        except Exception as e:
+            print(f"Lỗi trong khi Graph thực thi: {e}")
+            response_text = "Xin lỗi, đã có lỗi xảy ra trong quá trình suy nghĩ (Graph Error)."
+
+    await save_chat_record(payload.user_id, payload.prompt, response_text)
+    if not cached:
+        # Lượt trả từ cache không tốn lần gọi LLM nào, kể cả tóm tắt
+        schedule_summary_update(payload.user_id)
+
+    return {"user_id": payload.user_id, "response": response_text, "cached": cached}
+
+# --- 9b. Endpoint streaming (NDJSON) ---
+# Mỗi dòng là 1 sự kiện JSON:
+#   {"type": "route", "route": ...}                  quyết định của router
+#   {"type": "tool_start", "tool": ..., "input": ...}
+#   {"type": "tool_end", "tool": ..., "output": ...}
+#   {"type": "token", "content": ...}                token của câu trả lời (LLM chuyên gia)
+#   {"type": "done", "response": ..., "cached": ...} câu trả lời đầy đủ (đã lưu MongoDB)
+ANSWER_NODES = {"crypto_tools", "general_chat"}
+STREAM_TOOL_OUTPUT_MAX_CHARS = 500
+
+def ndjson(event: dict) -> str:
+    return json.dumps(event, ensure_ascii=False, default=str) + "\n"
+
+async def chat_event_stream(payload: ChatPrompt):
+    await ensure_agent_runtime()
+    if graph_app is None or db is None:
+        yield ndjson({"type": "error", "message": "LỖI: AI Graph hoặc CSDL chưa được khởi tạo."})
+        return
+
+    (chat_history_messages, db_records), summary_state = await asyncio.gather(
+        load_chat_history(payload.user_id), load_conversation_summary(payload.user_id)
+    )
+    chat_history_messages.append(HumanMessage(content=payload.prompt))
+    inputs = {
+        "messages": chat_history_messages,
+        "summary": summary_state["summary"],
+        "verbatim_turns": unsummarized_turns(db_records, summary_state["covered_until"]),
+    }
+
+    cached_text = await get_cached_response(payload.prompt, db_records, summary_state["summary"])
+    if cached_text is not None:
+        await save_chat_record(payload.user_id, payload.prompt, cached_text)
+        yield ndjson({"type": "token", "content": cached_text})
+        yield ndjson({"type": "done", "user_id": payload.user_id, "response": cached_text, "cached": True})
+        return
+
+    tokens: list[str] = []
+    final_state = None
+    try:
+        async for event in graph_app.astream_events(inputs, version="v2"):
+            kind = event["event"]
+            node = event.get("metadata", {}).get("langgraph_node")
+            if kind == "on_chain_end" and event["name"] == "router" and node == "router":
+                route = (event["data"].get("output") or {}).get("route")
+                if route:
+                    yield ndjson({"type": "route", "route": route})
+            elif kind == "on_tool_start":
+                yield ndjson({"type": "tool_start", "tool": event["name"], "input": event["data"].get("input")})
+            elif kind == "on_tool_end":
+                output = str(event["data"].get("output"))[:STREAM_TOOL_OUTPUT_MAX_CHARS]
+                yield ndjson({"type": "tool_end", "tool": event["name"], "output": output})
+            elif kind == "on_chat_model_stream" and node in ANSWER_NODES:
+                content = event["data"]["chunk"].content
+                if content:
+                    tokens.append(content)
+                    yield ndjson({"type": "token", "content": content})
+            elif kind == "on_chain_end" and not event.get("parent_ids"):
+                final_state = event["data"].get("output")
+        if final_state and final_state.get("messages"):
+            response_text = final_state["messages"][-1].content
+            await store_cached_response(
+                payload.prompt, db_records, summary_state["summary"],
+                final_state.get("route"), final_state.get("tools_used", []), response_text,
+            )
+        else:
+            response_text = "".join(tokens)
     except Exception as e:
-        print(f"Lỗi trong khi Graph thực thi: {e}")
+        print(f"Lỗi trong khi Graph thực thi (stream): {e}")
         response_text = "Xin lỗi, đã có lỗi xảy ra trong quá trình suy nghĩ (Graph Error)."
+        yield ndjson({"type": "error", "message": response_text})
+
+    await save_chat_record(payload.user_id, payload.prompt, response_text)
+    schedule_summary_update(payload.user_id)
+    yield ndjson({"type": "done", "user_id": payload.user_id, "response": response_text, "cached": False})
+
+class AdmittedStreamingResponse(StreamingResponse):
+    """
+    StreamingResponse giữ 1 slot admission: slot được trả khi response kết thúc theo MỌI cách,
+    kể cả khi client ngắt trước khi body bắt đầu (generator chưa chạy nên finally của nó không bao giờ chạy).
+    """
+
+    def __init__(self, content, user_id: str, started: float, **kwargs):
+        super().__init__(content, **kwargs)
+        self.user_id = user_id
+        self.started = started
 
-    # --- LƯU VÀO MONGODB (Không đổi) ---
-    # (Lưu lại cặp hỏi-đáp MỚI NHẤT này)
-    if db is not None:
+    async def __call__(self, scope, receive, send):
         try:
-            chat_record = {
-                "user_id": payload.user_id,
-                "prompt": payload.prompt, # Câu hỏi của người dùng
-                "response": response_text, # Câu trả lời của AI
-                "timestamp": datetime.datetime.now(datetime.timezone.utc)
-            }
-            db.chat_history.insert_one(chat_record)
-            print("Đã lưu chat (từ Agent) vào MongoDB.")
-        except Exception as e:
-            print(f"Lỗi khi lưu vào MongoDB: {e}")
+            await super().__call__(scope, receive, send)
+        finally:
+            release_run_slot(self.user_id, time.monotonic() - self.started)
+
+@app.post("/api/v1/agent/chat/stream")
+async def handle_chat_stream(payload: ChatPrompt):
+    print(f"Graph (stream) nhận prompt: {payload.prompt} từ user: {payload.user_id}")
+    # Chiếm slot TRƯỚC khi bắt đầu stream để còn trả được 429; AdmittedStreamingResponse trả slot khi xong
+    await acquire_run_slot(payload.user_id)
+    return AdmittedStreamingResponse(
+        chat_event_stream(payload),
+        user_id=payload.user_id,
+        started=time.monotonic(),
+        media_type="application/x-ndjson",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+# --- 10. Lịch sử chat: phân trang keyset + export streaming ---
+HISTORY_PAGE_MAX = 100
+HISTORY_EXPORT_BATCH_SIZE = 500
+
+def encode_history_cursor(doc: dict) -> str:
+    raw = json.dumps({"t": doc["timestamp"].isoformat(), "id": str(doc["_id"])})
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+def decode_history_cursor(cursor: str) -> tuple[datetime.datetime, ObjectId]:
+    try:
+        raw = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return datetime.datetime.fromisoformat(raw["t"]), ObjectId(raw["id"])
+    except (ValueError, KeyError, TypeError, InvalidId):
+        raise HTTPException(status_code=400, detail="Cursor không hợp lệ.")
+
+def history_query(user_id: str | None, cursor: str | None) -> dict:
+    """Lọc theo user (dùng index user_id_timestamp_id) và lấy các bản ghi 'cũ hơn' cursor."""
+    query: dict = {}
+    if user_id:
+        query["user_id"] = user_id
+    if cursor:
+        timestamp, last_id = decode_history_cursor(cursor)
+        query["$or"] = [
+            {"timestamp": {"$lt": timestamp}},
+            {"timestamp": timestamp, "_id": {"$lt": last_id}},
+        ]
+    return query
 
-    return {"user_id": payload.user_id, "response": response_text}
+HISTORY_SORT = [("timestamp", DESCENDING), ("_id", DESCENDING)]
+
+def serialize_history_doc(doc: dict) -> dict:
+    doc["_id"] = str(doc["_id"])
+    if isinstance(doc.get("timestamp"), datetime.datetime):
+        doc["timestamp"] = doc["timestamp"].isoformat()
+    return doc
 
-# Endpoint kiểm tra CSDL (Không đổi)
 @app.get("/api/v1/agent/history")
-async def get_chat_history():
+async def get_chat_history(user_id: str | None = None, limit: int = 20, cursor: str | None = None):
+    """
+    Lịch sử chat, mới nhất trước. Phân trang keyset: truyền `next_cursor` của trang trước vào `cursor`.
+    """
     if db is None:
         return {"error": "CSDL chưa kết nối"}
-    history = []
-    # (Tăng limit lên 20 để xem được nhiều hơn)
-    cursor = db.chat_history.find().sort("timestamp", -1).limit(20)
-    for doc in cursor:
-        doc["_id"] = str(doc["_id"])
-        history.append(doc)
-    return history
\ No newline at end of file
+    limit = max(1, min(limit, HISTORY_PAGE_MAX))
+    # Lấy dư 1 bản ghi để biết còn trang sau hay không
+    docs = await db.chat_history.find(history_query(user_id, cursor)).sort(HISTORY_SORT).limit(limit + 1).to_list(limit + 1)
+    has_more = len(docs) > limit
+    docs = docs[:limit]
+    next_cursor = encode_history_cursor(docs[-1]) if has_more else None
+    return {"items": [serialize_history_doc(doc) for doc in docs], "next_cursor": next_cursor}
+
+@app.get("/api/v1/agent/history/export")
+async def export_chat_history(user_id: str | None = None, cursor: str | None = None):
+    """
+    Export toàn bộ lịch sử (NDJSON, mới nhất trước), stream từng document ngay khi đọc từ cursor
+    MongoDB - không dựng list trong bộ nhớ.
+    """
+    if db is None:
+        raise HTTPException(status_code=503, detail="CSDL chưa kết nối")
+
+    async def export_lines():
+        mongo_cursor = db.chat_history.find(history_query(user_id, cursor)).sort(HISTORY_SORT).batch_size(HISTORY_EXPORT_BATCH_SIZE)
+        async for doc in mongo_cursor:
+            yield json.dumps(serialize_history_doc(doc), ensure_ascii=False) + "\n"
+
+    # user_id do client gửi: chỉ giữ ký tự an toàn để không phá header (dấu nháy, CR/LF...)
+    safe_user_id = re.sub(r"[^A-Za-z0-9_.-]", "_", user_id) if user_id else "all"
+    filename = f"chat_history_{safe_user_id}.ndjson"
+    return StreamingResponse(
+        export_lines(),
+        media_type="application/x-ndjson",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
+IMPORT_SECONDS = time.perf_counter() - IMPORT_STARTED
+readiness["import_seconds"] = round(IMPORT_SECONDS, 3)
+if IMPORT_SECONDS > IMPORT_TIME_BUDGET:
+    print(f"CẢNH BÁO: import module mất {IMPORT_SECONDS:.2f}s (ngân sách {IMPORT_TIME_BUDGET}s)")
+else:
+    print(f"Import module mất {IMPORT_SECONDS:.2f}s (ngân sách {IMPORT_TIME_BUDGET}s)")
@@ -1,11 +1,23 @@
-from fastapi import FastAPI, HTTPException, status
+from fastapi import FastAPI, HTTPException, Request, status
+from fastapi.responses import Response, StreamingResponse
 from pydantic import BaseModel
 from fastapi.middleware.cors import CORSMiddleware
 import redis
+import redis.asyncio as aioredis
 import os
 import httpx
 import time
 import base64 # <-- 1. THÊM IMPORT
+import asyncio
+import json
+from typing import Literal
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+import contextvars
+import math
+import re
+import numpy as np
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Histogram, generate_latest
 
 # --- Import Solana (Không đổi) ---
 from solders.keypair import Keypair
@@ -13,22 +25,70 @@ from solders.pubkey import Pubkey
 from solders.transaction import Transaction
 from solders.compute_budget import set_compute_unit_limit, set_compute_unit_price
 from solders.transaction import VersionedTransaction # <-- 2. THÊM IMPORT
-from solana.rpc.api import Client
+from solana.rpc.async_api import AsyncClient
+from solana.exceptions import SolanaRpcException
 from solana.rpc.types import TxOpts
 from solana.rpc.commitment import Confirmed
+from solders.signature import Signature
+from solders.transaction_status import TransactionConfirmationStatus
 from spl.token.constants import TOKEN_PROGRAM_ID
 import based58 
 
 # --- 3. Đọc Biến môi trường (Không đổi) ---
 REDIS_HOST = os.getenv("REDIS_HOST", "localhost")
+REDIS_PORT = int(os.getenv("REDIS_PORT", "6379"))
 CREATOR_PRIVATE_KEY_B58 = os.getenv("CREATOR_PRIVATE_KEY") 
 
 # --- 4. Biến toàn cục & Khởi tạo (Không đổi) ---
 redis_client = None
 http_client = None
 solana_client = None 
+solana_clients: dict[str, AsyncClient] = {}  # endpoint RPC -> client (xem mục 19)
 creator_keypair = None 
-SOLANA_RPC_URL = "https://api.mainnet-beta.solana.com"
+
+def env_endpoints(name: str, default: str) -> list[str]:
+    """Biến môi trường chứa 1 hoặc nhiều endpoint, cách nhau bởi dấu phẩy (endpoint đầu tiên là endpoint chính)."""
+    return [e.strip().rstrip("/") for e in os.getenv(name, default).split(",") if e.strip()]
+
+SOLANA_RPC_URLS = env_endpoints("SOLANA_RPC_URL", "https://api.mainnet-beta.solana.com")
+background_tasks: list[asyncio.Task] = []
+
+# Cache giá 2 tầng TTL:
+# - Sau PRICE_SOFT_TTL giây giá bị coi là "cũ": vẫn trả về ngay, đồng thời làm mới ở nền.
+# - Sau PRICE_HARD_TTL giây Redis tự xóa key: lúc đó mới phải chờ Jupiter.
+PRICE_SOFT_TTL = float(os.getenv("PRICE_SOFT_TTL", "10"))
+PRICE_HARD_TTL = int(os.getenv("PRICE_HARD_TTL", "60"))
+# Các lần gọi Jupiter đang chạy, theo symbol (single-flight)
+price_inflight: dict[str, asyncio.Task] = {}
+# Luồng giá (server push): 1 vòng lặp nền làm mới các cặp này rồi publish lên Redis pub/sub
+PRICE_STREAM_SYMBOLS = [s.strip() for s in os.getenv("PRICE_STREAM_SYMBOLS", "SOL-USDT").split(",") if s.strip()]
+PRICE_STREAM_INTERVAL = float(os.getenv("PRICE_STREAM_INTERVAL", "1.0"))
+PRICE_STREAM_CHANNEL = "price-updates"
+PRICE_STREAM_QUEUE_SIZE = 100  # mỗi client SSE; client chậm sẽ bị bỏ bớt tin cũ
+latest_prices: dict[str, dict] = {}
+price_subscribers: set[asyncio.Queue] = set()
+# Cache thông tin coin Pump.fun 2 tầng: LRU trong process (L1) -> Redis (L2) -> Pump.fun
+COIN_CACHE_L1_SIZE = int(os.getenv("COIN_CACHE_L1_SIZE", "2048"))
+COIN_CACHE_L1_TTL = float(os.getenv("COIN_CACHE_L1_TTL", "30"))
+COIN_CACHE_REDIS_TTL = int(os.getenv("COIN_CACHE_REDIS_TTL", "300"))
+COIN_NEGATIVE_TTL = int(os.getenv("COIN_NEGATIVE_TTL", "300"))  # mint không tồn tại cũng được cache
+COIN_NOT_FOUND = "__not_found__"
+PUMPFUN_BULK_CONCURRENCY = int(os.getenv("PUMPFUN_BULK_CONCURRENCY", "8"))
+PUMPFUN_BULK_MAX = int(os.getenv("PUMPFUN_BULK_MAX", "50"))
+coin_cache_l1: OrderedDict[str, tuple[float, dict | None]] = OrderedDict()  # mint -> (hết hạn, data | None)
+# Số cặp tối đa cho endpoint giá bulk
+MAX_BULK_SYMBOLS = int(os.getenv("MAX_BULK_SYMBOLS", "100"))
+# Chuỗi tick giá trong bộ nhớ (NumPy ring buffer mỗi symbol) để tính chỉ báo (SMA/EMA/VWAP, volatility...)
+TICK_BUFFER_SIZE = int(os.getenv("TICK_BUFFER_SIZE", "2048"))  # số tick giữ lại mỗi symbol
+TICK_MAX_SYMBOLS = int(os.getenv("TICK_MAX_SYMBOLS", "256"))  # quá số này thì bỏ symbol lâu không có tick nhất
+QUOTE_SYMBOLS = ("USDC", "USDT")  # đồng định giá khi ghi tick từ lệnh swap
+# Kho tick trên đĩa (mặc định rỗng = tắt; docker-compose đặt /data/ticks): segment theo thời gian,
+# xóa segment cũ hơn TICK_RETENTION_DAYS
+TICK_ARCHIVE_DIR = os.getenv("TICK_ARCHIVE_DIR", "")
+TICK_SEGMENT_SECONDS = int(os.getenv("TICK_SEGMENT_SECONDS", "86400"))  # 1 segment / ngày
+TICK_RETENTION_DAYS = float(os.getenv("TICK_RETENTION_DAYS", "180"))
+TICK_ARCHIVE_FLUSH_INTERVAL = float(os.getenv("TICK_ARCHIVE_FLUSH_INTERVAL", "1.0"))
+TICK_MAX_BARS = int(os.getenv("TICK_MAX_BARS", "5000"))
 
 # --- 5. Định nghĩa các địa chỉ (Pump.fun) (Không đổi) ---
 PUMP_PROGRAM_ID = Pubkey.from_string("6EF8rrecthR5DkVZW8NMCnwtd39Sjfu9mt33KjkkvM6r")
@@ -53,18 +113,95 @@ DECIMALS = {
     "WIF": 6,
 }
 # API của Jupiter (V6)
-JUPITER_QUOTE_API = "https://quote-api.jup.ag/v6/quote"
-JUPITER_SWAP_API = "https://quote-api.jup.ag/v6/swap"
+# (Có thể trỏ sang server giả lập khi benchmark, xem thư mục benchmarks/)
+# Mỗi biến nhận nhiều endpoint cách nhau bởi dấu phẩy: endpoint sau dùng để hedge / failover (mục 19)
+JUPITER_QUOTE_APIS = env_endpoints("JUPITER_QUOTE_API", "https://quote-api.jup.ag/v6/quote")
+JUPITER_SWAP_APIS = env_endpoints("JUPITER_SWAP_API", "https://quote-api.jup.ag/v6/swap")
+JUPITER_PRICE_APIS = env_endpoints("JUPITER_PRICE_API", "https://price.jup.ag/v4/price")
+PUMPFUN_APIS = env_endpoints("PUMPFUN_API", "https://frontend-api.pump.fun")
+
+# Endpoint batch: số lệnh chuẩn bị (quote + swap build) song song tối đa, và số lệnh tối đa mỗi batch
+TRADE_BATCH_CONCURRENCY = int(os.getenv("TRADE_BATCH_CONCURRENCY", "4"))
+TRADE_BATCH_MAX_ORDERS = int(os.getenv("TRADE_BATCH_MAX_ORDERS", "20"))
+
+# Cache quote Jupiter (trong process). Key: (inputMint, outputMint, amount bucket, slippageBps)
+QUOTE_CACHE_TTL = float(os.getenv("QUOTE_CACHE_TTL", "1.0"))  # giới hạn độ cũ tối đa của quote (giây)
+QUOTE_CACHE_MAX_ENTRIES = int(os.getenv("QUOTE_CACHE_MAX_ENTRIES", "1024"))
+# Tùy chọn: làm tròn XUỐNG số lượng lệnh về N chữ số có nghĩa để các lệnh gần giống nhau dùng chung quote
+# (0 = tắt, mặc định). Đây là số lượng thực thi thật: lệnh không bao giờ vượt số lượng yêu cầu,
+# nhưng với 4 chữ số có thể khớp ít hơn tối đa ~0.1%.
+QUOTE_AMOUNT_SIG_DIGITS = int(os.getenv("QUOTE_AMOUNT_SIG_DIGITS", "0"))
+# Prefetch (tùy chọn): "USDC-SOL:10,SOL-USDC:0.5" = giữ quote luôn nóng cho các cặp/số lượng này
+QUOTE_PREFETCH_PAIRS = os.getenv("QUOTE_PREFETCH_PAIRS", "")
+QUOTE_PREFETCH_INTERVAL = float(os.getenv("QUOTE_PREFETCH_INTERVAL", "0.8"))
+quote_cache: dict[tuple, tuple[float, dict]] = {}  # key -> (thời điểm lấy, quote)
+quote_inflight: dict[tuple, asyncio.Task] = {}
+quote_cache_stats = {"hits": 0, "misses": 0, "expired": 0, "near_misses": 0, "prefetches": 0, "errors": 0}
+
+# Phí ưu tiên (computeUnitPriceMicroLamports) theo urgency của lệnh, ước lượng từ getRecentPrioritizationFees
+PRIORITY_FEE_SAMPLE_INTERVAL = float(os.getenv("PRIORITY_FEE_SAMPLE_INTERVAL", "10"))
+PRIORITY_FEE_MAX_AGE = float(os.getenv("PRIORITY_FEE_MAX_AGE", "60"))  # bảng cũ hơn -> dùng mức mặc định
+# Tài khoản ghi (writable) để lọc phí theo vùng tranh chấp (mặc định: program Jupiter v6).
+# Không truyền tài khoản thì RPC trả phí THẤP NHẤT mỗi slot trên toàn mạng (gần như luôn 0) -> vô dụng.
+PRIORITY_FEE_ACCOUNTS = [
+    a.strip() for a in os.getenv("PRIORITY_FEE_ACCOUNTS", "JUP6LkbZbjS1jKKwapdHNy74zcZ3tLUZoi5QNyVTaV4").split(",")
+    if a.strip()
+]
+PRIORITY_FEE_MIN = int(os.getenv("PRIORITY_FEE_MIN", "1000"))
+PRIORITY_FEE_MAX = int(os.getenv("PRIORITY_FEE_MAX", "5000000"))
+PRIORITY_FEE_DEFAULTS = {"economy": 50_000, "normal": 300_000, "fast": 1_000_000}  # khi chưa có dữ liệu
+# Tỉ lệ slot có phí > 0 để coi là nghẽn bình thường / cao
+PRIORITY_FEE_NORMAL_CONGESTION = float(os.getenv("PRIORITY_FEE_NORMAL_CONGESTION", "0.3"))
+PRIORITY_FEE_HIGH_CONGESTION = float(os.getenv("PRIORITY_FEE_HIGH_CONGESTION", "0.7"))
+# Mức nghẽn -> urgency -> percentile phí của các slot gần đây
+PRIORITY_FEE_TIER_PERCENTILES = {
+    "low": {"economy": 25, "normal": 50, "fast": 75},
+    "normal": {"economy": 50, "normal": 75, "fast": 90},
+    "high": {"economy": 75, "normal": 90, "fast": 99},
+}
+
+# --- 6b. Theo dõi xác nhận giao dịch ---
+SOLANA_RPC_TIMEOUT = float(os.getenv("SOLANA_RPC_TIMEOUT", "10"))
+SIGNATURE_POLL_INTERVAL = float(os.getenv("SIGNATURE_POLL_INTERVAL", "1.0"))  # giây giữa 2 lần poll
+SIGNATURE_TRACK_TIMEOUT = float(os.getenv("SIGNATURE_TRACK_TIMEOUT", "90"))  # quá hạn -> 'expired'
+SIGNATURE_RESULT_TTL = float(os.getenv("SIGNATURE_RESULT_TTL", "600"))  # giữ kết quả để client poll
+SIGNATURE_STATUS_BATCH = 256  # giới hạn số chữ ký mỗi lần gọi getSignatureStatuses
+
+# --- 6c. Lớp gọi upstream (mục 19) ---
+# Budget độ trễ (giây) cho cả 1 lần gọi, kể cả hedge / failover; ghi đè bằng UPSTREAM_BUDGET_<TÊN>
+UPSTREAM_BUDGETS = {
+    name: float(os.getenv(f"UPSTREAM_BUDGET_{name.upper()}", default))
+    for name, default in {
+        "jupiter_price": "1.5",
+        "jupiter_quote": "2.0",
+        "jupiter_swap": "4.0",
+        "pumpfun": "3.0",
+        "solana_rpc": str(SOLANA_RPC_TIMEOUT),
+    }.items()
+}
+UPSTREAM_HEDGE_PERCENTILE = float(os.getenv("UPSTREAM_HEDGE_PERCENTILE", "95"))  # gửi bản sao khi quá p95
+UPSTREAM_HEDGE_MIN_DELAY = float(os.getenv("UPSTREAM_HEDGE_MIN_DELAY", "0.02"))
+UPSTREAM_HEDGE_MAX_RATIO = float(os.getenv("UPSTREAM_HEDGE_MAX_RATIO", "0.1"))  # tối đa ~10% lần gọi được hedge
+UPSTREAM_HEDGE_BURST = 10.0
+UPSTREAM_LATENCY_WINDOW = int(os.getenv("UPSTREAM_LATENCY_WINDOW", "512"))  # số mẫu độ trễ để tính p95
+UPSTREAM_LATENCY_MIN_SAMPLES = 20  # ít mẫu hơn -> chờ nửa budget mới hedge
+UPSTREAM_BREAKER_FAILURES = int(os.getenv("UPSTREAM_BREAKER_FAILURES", "5"))  # lỗi liên tiếp để mở breaker
+UPSTREAM_BREAKER_COOLDOWN = float(os.getenv("UPSTREAM_BREAKER_COOLDOWN", "10"))  # giây trước khi cho 1 request thử
+# Khi không lấy được giá từ Jupiter: dùng tick gần nhất trong bộ nhớ nếu chưa cũ hơn ngưỡng này
+UPSTREAM_STALE_PRICE_MAX_AGE = float(os.getenv("UPSTREAM_STALE_PRICE_MAX_AGE", "300"))
+# signature -> {"status": pending|confirmed|failed|expired, ...}
+tracked_signatures: dict[str, dict] = {}
+signature_events: dict[str, asyncio.Event] = {}
 
 # --- 7. Sự kiện Startup/Shutdown (Không đổi) ---
 app = FastAPI(title="Auto Trading Service (Với Pump.fun & Jupiter Swap)")
 
 @app.on_event("startup")
-def startup_app():
+async def startup_app():
     # ... (Toàn bộ hàm startup không đổi)
-    global redis_client, http_client, solana_client, creator_keypair
+    global redis_client, http_client, solana_client, solana_clients, creator_keypair
     try:
-        redis_client = redis.Redis(host=REDIS_HOST, port=6379, db=0, decode_responses=True)
+        redis_client = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=0, decode_responses=True)
         redis_client.ping()
         print("Đã kết nối thành công đến Redis!")
     except Exception as e:
@@ -72,26 +209,112 @@ def startup_app():
     http_client = httpx.AsyncClient(timeout=10.0)
     print("Đã khởi tạo HTTPX Client.")
     try:
-        solana_client = Client(SOLANA_RPC_URL)
-        print(f"Đã kết nối Solana RPC: {SOLANA_RPC_URL}")
+        # AsyncClient giữ 1 connection pool (httpx) suốt vòng đời app, không chặn event loop.
+        # Mỗi endpoint RPC 1 client; lời gọi đi qua upstreams["solana_rpc"] để hedge / failover.
+        solana_clients = {url: AsyncClient(url, timeout=SOLANA_RPC_TIMEOUT) for url in SOLANA_RPC_URLS}
+        solana_client = solana_clients[SOLANA_RPC_URLS[0]]
+        print(f"Đã kết nối Solana RPC: {', '.join(SOLANA_RPC_URLS)}")
         if not CREATOR_PRIVATE_KEY_B58:
             raise Exception("CREATOR_PRIVATE_KEY chưa được thiết lập!")
-        private_key_bytes = based58.b58decode(CREATOR_PRIVATE_KEY_B58)
+        private_key_bytes = based58.b58decode(CREATOR_PRIVATE_KEY_B58.encode())
         creator_keypair = Keypair.from_bytes(private_key_bytes)
         print(f"Đã tải ví người tạo (Creator): {creator_keypair.pubkey()}")
     except Exception as e:
         print(f"LỖI NGHIÊM TRỌNG khi khởi tạo Solana hoặc Private Key: {e}")
+    background_tasks.append(asyncio.create_task(confirmation_tracker_loop()))
+    if PRICE_STREAM_SYMBOLS:
+        background_tasks.append(asyncio.create_task(price_ingestion_loop()))
+    background_tasks.append(asyncio.create_task(price_stream_listener()))
+    if QUOTE_PREFETCH_PAIRS:
+        background_tasks.append(asyncio.create_task(quote_prefetch_loop()))
+    if TICK_ARCHIVE_DIR:
+        background_tasks.append(asyncio.create_task(tick_archive_loop()))
+    if PRIORITY_FEE_SAMPLE_INTERVAL > 0:
+        background_tasks.append(asyncio.create_task(priority_fee_loop()))
 
 @app.on_event("shutdown")
 async def shutdown_app():
+    for task in background_tasks:
+        task.cancel()
+    if TICK_ARCHIVE_DIR:
+        await flush_tick_archive()
     if http_client:
-        await http_client.acclose()
+        await http_client.aclose()
         print("Đã đóng HTTPX Client.")
+    for client in solana_clients.values():
+        await client.close()
+    if solana_clients:
+        print("Đã đóng Solana RPC Client.")
 
 # --- 8. Cấu hình CORS (Không đổi) ---
 origins = ["http://localhost:3000"]
 app.add_middleware(CORSMiddleware, allow_origins=origins, allow_credentials=True, allow_methods=["*"], allow_headers=["*"])
 
+# --- 8b. Đo độ trễ (Prometheus) & Tracing theo từng bước ---
+# Request chậm hơn ngưỡng này sẽ được log kèm thời gian từng bước
+SLOW_REQUEST_MS = float(os.getenv("SLOW_REQUEST_MS", "1000"))
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+HTTP_LATENCY = Histogram(
+    "trading_http_request_seconds", "Độ trễ HTTP theo route",
+    ["method", "route", "status"], buckets=LATENCY_BUCKETS,
+)
+STAGE_LATENCY = Histogram(
+    "trading_stage_seconds", "Độ trễ từng bước xử lý (quote, swap_build, sign, send, redis, upstream...)",
+    ["operation", "stage"], buckets=LATENCY_BUCKETS,
+)
+PRICE_REQUEST_LATENCY = Histogram(
+    "trading_price_request_seconds", "Độ trễ /api/v1/price/{symbol} theo kết quả cache",
+    ["result"], buckets=LATENCY_BUCKETS,
+)
+CACHE_RESULTS = Counter("trading_cache_results_total", "Kết quả tra cache", ["cache", "result"])
+# Danh sách (bước, giây) của request hiện tại; None khi không nằm trong 1 request HTTP
+request_trace: contextvars.ContextVar[list | None] = contextvars.ContextVar("request_trace", default=None)
+
+@contextmanager
+def timed(operation: str, stage: str):
+    """Ghi thời gian 1 bước vào histogram và vào trace của request hiện tại (nếu có)."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        STAGE_LATENCY.labels(operation, stage).observe(elapsed)
+        trace = request_trace.get()
+        if trace is not None:
+            trace.append((f"{operation}.{stage}", elapsed))
+
+@app.middleware("http")
+async def trace_requests(request: Request, call_next):
+    """
+    Đo độ trễ mỗi request và trả thời gian từng bước trong header `Server-Timing`
+    (xem được ngay trong DevTools/curl -v). Request chậm được log kèm phân rã theo bước.
+    """
+    trace: list = []
+    token = request_trace.set(trace)
+    started = time.perf_counter()
+    status_code = 500
+    try:
+        response = await call_next(request)
+        status_code = response.status_code
+    finally:
+        elapsed = time.perf_counter() - started
+        request_trace.reset(token)
+        route = request.scope.get("route")
+        route_path = getattr(route, "path", "unmatched")
+        HTTP_LATENCY.labels(request.method, route_path, str(status_code)).observe(elapsed)
+    if trace:
+        response.headers["Server-Timing"] = ", ".join(
+            f"{name};dur={seconds * 1000:.2f}" for name, seconds in trace
+        )
+    if elapsed * 1000 > SLOW_REQUEST_MS:
+        breakdown = ", ".join(f"{name}={seconds * 1000:.1f}ms" for name, seconds in trace)
+        print(f"REQUEST CHẬM: {request.method} {request.url.path} {elapsed * 1000:.1f}ms [{breakdown}]")
+    return response
+
+@app.get("/metrics")
+async def metrics():
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
 # --- 9. Mô hình Pydantic (THAY ĐỔI) ---
 
 # ĐỊNH NGHĨA LẠI TRADEORDER CHO RÕ RÀNG
@@ -101,6 +324,8 @@ class TradeOrder(BaseModel):
     output_symbol: str  # Ví dụ: "SOL"
     amount: float       # Số lượng (ví dụ: 10.5) -> nghĩa là 10.5 USDC
     slippage_bps: int = 50 # 50 bps = 0.5%
+    max_quote_age_ms: int | None = None # Quote cache cũ tối đa bao nhiêu ms (0 = luôn lấy quote mới)
+    urgency: Literal["economy", "normal", "fast"] = "normal" # Mức phí ưu tiên (xem /api/v1/trade/priority-fees)
 
 class CreateTokenInput(BaseModel): # (Không đổi)
     name: str
@@ -116,53 +341,366 @@ class CreateTokenInput(BaseModel): # (Không đổi)
 async def get_price_from_jupiter_api(symbol: str): 
     print(f"ĐANG GỌI API JUPITER... cho {symbol}")
     base, quote = symbol.split('-')
-    url = f"https://price.jup.ag/v4/price?ids={base}&vsToken={quote}"
     try:
-        if not http_client:
-            raise Exception("HTTP Client chưa được khởi tạo")
-        response = await http_client.get(url)
+        with timed("price", "jupiter"):
+            response = await upstream_request(
+                "jupiter_price", "GET", params={"ids": base, "vsToken": quote}, hedge=True
+            )
         response.raise_for_status() 
         data = response.json()
         price = data.get("data", {}).get(base, {}).get("price")
         if price is None:
             return None 
-        return round(price, 6)
+        price = round(price, 6)
+        record_tick(symbol, price)
+        return price
     except Exception as e:
         print(f"Lỗi khi gọi API Jupiter: {e}")
         return None
 
+def decode_cached_price(raw: str):
+    """Đọc giá trị cache -> (price, fetched_at). Giá trị cũ (chỉ có số) coi như đã hết soft TTL."""
+    try:
+        value = json.loads(raw)
+    except (TypeError, ValueError):
+        return None, 0.0
+    if isinstance(value, dict):
+        return value.get("price"), float(value.get("ts", 0.0))
+    return value, 0.0
+
+def encode_cached_price(price: float) -> str:
+    return json.dumps({"price": price, "ts": time.time()})
+
+async def refresh_price(symbol: str):
+    """Gọi Jupiter 1 lần và ghi kết quả vào Redis (kèm thời điểm lấy giá)."""
+    price = await get_price_from_jupiter_api(symbol)
+    if price is not None and redis_client is not None:
+        try:
+            redis_client.set(f"price:{symbol}", encode_cached_price(price), ex=PRICE_HARD_TTL)
+        except Exception as e:
+            print(f"Lỗi khi ghi giá vào Redis: {e}")
+    return price
+
+def track_inflight(symbol: str, task: asyncio.Task) -> asyncio.Task:
+    """Ghi nhận lần gọi đang chạy của symbol, tự xóa khi xong."""
+    price_inflight[symbol] = task
+
+    def _done(t: asyncio.Task):
+        if price_inflight.get(symbol) is t:
+            del price_inflight[symbol]
+    task.add_done_callback(_done)
+    return task
+
+def fetch_price_single_flight(symbol: str) -> asyncio.Task:
+    """
+    Gộp các yêu cầu đồng thời: mỗi symbol chỉ có tối đa 1 lần gọi Jupiter đang chạy,
+    mọi người chờ cùng dùng chung kết quả.
+    """
+    task = price_inflight.get(symbol)
+    if task is None:
+        task = track_inflight(symbol, asyncio.create_task(refresh_price(symbol)))
+    return task
+
+async def get_prices_from_jupiter_api(symbols: list[str]) -> dict[str, float]:
+    """
+    Lấy giá nhiều cặp cùng lúc. Jupiter chỉ nhận 1 vsToken mỗi request,
+    nên gom theo đồng quote: mỗi quote chỉ tốn 1 lần gọi `price?ids=A,B,C`.
+    """
+    bases_by_quote: dict[str, list[str]] = {}
+    for symbol in symbols:
+        base, quote = symbol.split('-')
+        bases_by_quote.setdefault(quote, []).append(base)
+
+    async def fetch_quote_group(quote: str, bases: list[str]) -> dict[str, float]:
+        print(f"ĐANG GỌI API JUPITER (bulk)... {len(bases)} cặp theo {quote}")
+        try:
+            with timed("price", "jupiter_bulk"):
+                response = await upstream_request(
+                    "jupiter_price", "GET", params={"ids": ",".join(bases), "vsToken": quote}, hedge=True
+                )
+            response.raise_for_status()
+            data = response.json().get("data", {})
+        except Exception as e:
+            print(f"Lỗi khi gọi API Jupiter (bulk): {e}")
+            return {}
+        prices = {}
+        for base in bases:
+            price = data.get(base, {}).get("price")
+            if price is not None:
+                prices[f"{base}-{quote}"] = round(price, 6)
+        now = time.time()
+        for symbol, price in prices.items():
+            record_tick(symbol, price, ts=now)
+        return prices
+
+    results = await asyncio.gather(*(fetch_quote_group(q, b) for q, b in bases_by_quote.items()))
+    merged: dict[str, float] = {}
+    for group in results:
+        merged.update(group)
+    return merged
+
+def store_prices(prices: dict[str, float]):
+    """Ghi nhiều giá vào Redis bằng 1 pipeline (1 round trip)."""
+    if not prices or redis_client is None:
+        return
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        for symbol, price in prices.items():
+            pipe.set(f"price:{symbol}", encode_cached_price(price), ex=PRICE_HARD_TTL)
+        pipe.execute()
+    except Exception as e:
+        print(f"Lỗi khi ghi giá (pipeline) vào Redis: {e}")
+
+async def refresh_prices(symbols: list[str]) -> dict[str, float]:
+    prices = await get_prices_from_jupiter_api(symbols)
+    store_prices(prices)
+    return prices
+
+def fetch_prices_single_flight(symbols: list[str]) -> dict[str, asyncio.Task]:
+    """
+    Phiên bản nhiều symbol của fetch_price_single_flight: symbol nào đang có lần gọi
+    chạy thì dùng lại, phần còn lại gom vào 1 lần gọi bulk duy nhất.
+    """
+    tasks = {s: price_inflight[s] for s in symbols if s in price_inflight}
+    missing = [s for s in symbols if s not in tasks]
+    if missing:
+        batch = asyncio.create_task(refresh_prices(missing))
+
+        async def pick(symbol: str):
+            return (await batch).get(symbol)
+        for symbol in missing:
+            tasks[symbol] = track_inflight(symbol, asyncio.create_task(pick(symbol)))
+    return tasks
+
 @app.get("/api/v1/price/{symbol}") 
 async def get_cached_price(symbol: str):
+    started = time.perf_counter()
+    result = "error"
+    try:
+        response, result = await resolve_cached_price(symbol)
+        return response
+    finally:
+        PRICE_REQUEST_LATENCY.labels(result).observe(time.perf_counter() - started)
+
+async def resolve_cached_price(symbol: str) -> tuple[dict, str]:
+    """-> (response, kết quả cache: hit | stale | miss)."""
     if redis_client is None:
         raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Redis chưa kết nối.")
     cache_key = f"price:{symbol}"
-    cached_price = redis_client.get(cache_key)
-    if cached_price:
-        return {"symbol": symbol, "price": cached_price, "source": "Cache (Redis)"}
-    price = await get_price_from_jupiter_api(symbol) 
+    with timed("price", "redis_get"):
+        cached_raw = redis_client.get(cache_key)
+    if cached_raw:
+        cached_price, fetched_at = decode_cached_price(cached_raw)
+        if cached_price is not None:
+            if time.time() - fetched_at < PRICE_SOFT_TTL:
+                CACHE_RESULTS.labels("price", "hit").inc()
+                return {"symbol": symbol, "price": cached_price, "source": "Cache (Redis)"}, "hit"
+            # Giá đã cũ (nhưng chưa hết hard TTL): trả ngay, làm mới ở nền
+            CACHE_RESULTS.labels("price", "stale").inc()
+            fetch_price_single_flight(symbol)
+            return {"symbol": symbol, "price": cached_price, "source": "Cache (Redis, đang làm mới)"}, "stale"
+    # Cache miss: chờ lần gọi Jupiter chung (shield để 1 client hủy không hủy của người khác)
+    CACHE_RESULTS.labels("price", "miss").inc()
+    with timed("price", "upstream_wait"):
+        price = await asyncio.shield(fetch_price_single_flight(symbol))
     if price is None:
-        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Không thể lấy giá từ API Jupiter.")
-    redis_client.set(cache_key, price, ex=10) 
-    return {"symbol": symbol, "price": price, "source": "API (Jupiter)"}
+        # Jupiter lỗi / breaker mở: dùng tick gần nhất trong bộ nhớ nếu chưa quá cũ
+        price = stale_tick_price(symbol)
+        if price is None:
+            raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Không thể lấy giá từ API Jupiter.")
+        CACHE_RESULTS.labels("price", "fallback").inc()
+        return {"symbol": symbol, "price": price, "source": "Cache (tick gần nhất, Jupiter lỗi)"}, "fallback"
+    return {"symbol": symbol, "price": price, "source": "API (Jupiter)"}, "miss"
 
-@app.get("/api/v1/pumpfun/coin/{contract_address}") 
-async def get_pumpfun_coin_data(contract_address: str):
-    url = f"https://frontend-api.pump.fun/coins/{contract_address}"
+@app.get("/api/v1/prices")
+async def get_cached_prices(symbols: str):
+    """
+    Lấy giá nhiều cặp trong 1 request, ví dụ: /api/v1/prices?symbols=SOL-USDT,BONK-USDC
+    Đọc cache bằng 1 MGET, chỉ gọi Jupiter cho các cặp bị miss (gom thành 1 request bulk).
+    """
+    if redis_client is None:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Redis chưa kết nối.")
+    symbol_list = list(dict.fromkeys(s.strip() for s in symbols.split(",") if s.strip()))
+    if not symbol_list:
+        raise HTTPException(status_code=400, detail="Thiếu tham số symbols.")
+    if len(symbol_list) > MAX_BULK_SYMBOLS:
+        raise HTTPException(status_code=400, detail=f"Tối đa {MAX_BULK_SYMBOLS} cặp mỗi request.")
+    invalid = [s for s in symbol_list if s.count("-") != 1]
+    if invalid:
+        raise HTTPException(status_code=400, detail=f"Symbol không hợp lệ: {', '.join(invalid)}")
+
+    cached_values = redis_client.mget([f"price:{s}" for s in symbol_list])
+    results = {}
+    stale, missing = [], []
+    now = time.time()
+    for symbol, raw in zip(symbol_list, cached_values):
+        cached_price, fetched_at = decode_cached_price(raw) if raw else (None, 0.0)
+        if cached_price is None:
+            missing.append(symbol)
+        elif now - fetched_at < PRICE_SOFT_TTL:
+            results[symbol] = {"price": cached_price, "source": "Cache (Redis)"}
+        else:
+            stale.append(symbol)
+            results[symbol] = {"price": cached_price, "source": "Cache (Redis, đang làm mới)"}
+
+    if stale:
+        fetch_prices_single_flight(stale)
+    if missing:
+        tasks = fetch_prices_single_flight(missing)
+        fetched = await asyncio.gather(*(asyncio.shield(tasks[s]) for s in missing))
+        for symbol, price in zip(missing, fetched):
+            if price is None:
+                fallback = stale_tick_price(symbol)
+                if fallback is None:
+                    results[symbol] = {"price": None, "source": "Lỗi (Jupiter)"}
+                else:
+                    results[symbol] = {"price": fallback, "source": "Cache (tick gần nhất, Jupiter lỗi)"}
+            else:
+                results[symbol] = {"price": price, "source": "API (Jupiter)"}
+
+    return {"prices": {s: results[s] for s in symbol_list}}
+
+class CoinNotFound(Exception):
+    """Pump.fun trả 404: mint không tồn tại (được cache âm)."""
+
+async def fetch_pumpfun_coin(contract_address: str) -> dict:
+    headers = {"User-Agent": "Mozilla/5.0"}
+    response = await upstream_request("pumpfun", "GET", f"/coins/{contract_address}", headers=headers, hedge=True)
+    if response.status_code == 404:
+        raise CoinNotFound(contract_address)
+    response.raise_for_status()
+    data = response.json()
+    if not data:
+        raise CoinNotFound(contract_address)
+    filtered_data = {
+        "name": data.get("name"), "symbol": data.get("symbol"),
+        "description": data.get("description"), "market_cap_usd": data.get("market_cap"),
+        "contract_address": data.get("mint")
+    }
+    return filtered_data
+
+def coin_l1_get(contract_address: str):
+    """
+    -> (hit, data). data = None nghĩa là đã biết mint không tồn tại.
+    Entry hết hạn vẫn nằm trong LRU (đến khi bị đẩy ra) để phục vụ khi Pump.fun lỗi.
+    """
+    entry = coin_cache_l1.get(contract_address)
+    if entry is None:
+        return False, None
+    expires_at, data = entry
+    if time.monotonic() > expires_at:
+        return False, None
+    coin_cache_l1.move_to_end(contract_address)
+    return True, data
+
+def coin_l1_put(contract_address: str, data: dict | None):
+    coin_cache_l1[contract_address] = (time.monotonic() + COIN_CACHE_L1_TTL, data)
+    coin_cache_l1.move_to_end(contract_address)
+    while len(coin_cache_l1) > COIN_CACHE_L1_SIZE:
+        coin_cache_l1.popitem(last=False)
+
+def store_coins(coins: dict[str, dict | None]):
+    """Ghi vào L1 và Redis (1 pipeline). None -> cache âm với COIN_NEGATIVE_TTL."""
+    for contract_address, data in coins.items():
+        coin_l1_put(contract_address, data)
+    if not coins or redis_client is None:
+        return
     try:
-        if not http_client:
-            raise Exception("HTTP Client chưa được khởi tạo")
-        headers = {"User-Agent": "Mozilla/5.0"}
-        response = await http_client.get(url, headers=headers)
-        response.raise_for_status()
-        data = response.json()
-        filtered_data = {
-            "name": data.get("name"), "symbol": data.get("symbol"),
-            "description": data.get("description"), "market_cap_usd": data.get("market_cap"),
-            "contract_address": data.get("mint")
-        }
-        return filtered_data
+        pipe = redis_client.pipeline(transaction=False)
+        for contract_address, data in coins.items():
+            if data is None:
+                pipe.set(f"pumpfun:coin:{contract_address}", COIN_NOT_FOUND, ex=COIN_NEGATIVE_TTL)
+            else:
+                pipe.set(f"pumpfun:coin:{contract_address}", json.dumps(data), ex=COIN_CACHE_REDIS_TTL)
+        pipe.execute()
     except Exception as e:
-        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=f"Không thể lấy dữ liệu từ Pump.fun: {e}")
+        print(f"Lỗi khi ghi coin Pump.fun vào Redis: {e}")
+
+async def lookup_pumpfun_coins(addresses: list[str]) -> tuple[dict, dict]:
+    """
+    Tra nhiều mint: L1 -> Redis (1 MGET) -> Pump.fun (song song, tối đa PUMPFUN_BULK_CONCURRENCY).
+    Trả về (coins, errors): coins[mint] = data hoặc None (không tồn tại), errors[mint] = lỗi upstream.
+    """
+    coins: dict[str, dict | None] = {}
+    remaining = []
+    for contract_address in addresses:
+        hit, data = coin_l1_get(contract_address)
+        if hit:
+            coins[contract_address] = data
+        else:
+            remaining.append(contract_address)
+    CACHE_RESULTS.labels("pumpfun_l1", "hit").inc(len(addresses) - len(remaining))
+
+    if remaining and redis_client is not None:
+        try:
+            with timed("pumpfun", "redis_mget"):
+                cached_values = redis_client.mget([f"pumpfun:coin:{a}" for a in remaining])
+        except Exception as e:
+            print(f"Lỗi khi đọc coin Pump.fun từ Redis: {e}")
+            cached_values = [None] * len(remaining)
+        still_missing = []
+        for contract_address, raw in zip(remaining, cached_values):
+            if raw is None:
+                still_missing.append(contract_address)
+                continue
+            data = None if raw == COIN_NOT_FOUND else json.loads(raw)
+            coin_l1_put(contract_address, data)
+            coins[contract_address] = data
+        CACHE_RESULTS.labels("pumpfun_redis", "hit").inc(len(remaining) - len(still_missing))
+        remaining = still_missing
+
+    errors: dict[str, str] = {}
+    if remaining:
+        semaphore = asyncio.Semaphore(PUMPFUN_BULK_CONCURRENCY)
+
+        async def fetch_limited(contract_address: str):
+            async with semaphore:
+                return await fetch_pumpfun_coin(contract_address)
+
+        CACHE_RESULTS.labels("pumpfun", "miss").inc(len(remaining))
+        with timed("pumpfun", "upstream"):
+            results = await asyncio.gather(*(fetch_limited(a) for a in remaining), return_exceptions=True)
+        fetched: dict[str, dict | None] = {}
+        for contract_address, result in zip(remaining, results):
+            if isinstance(result, CoinNotFound):
+                fetched[contract_address] = None
+            elif isinstance(result, BaseException):
+                errors[contract_address] = str(result)
+            else:
+                fetched[contract_address] = result
+        store_coins(fetched)
+        coins.update(fetched)
+        # Pump.fun lỗi / breaker mở: trả bản cũ trong L1 (nếu còn) thay vì báo lỗi
+        for contract_address in list(errors):
+            entry = coin_cache_l1.get(contract_address)
+            if entry is not None:
+                coins[contract_address] = entry[1]
+                del errors[contract_address]
+                CACHE_RESULTS.labels("pumpfun_l1", "stale").inc()
+    return coins, errors
+
+@app.get("/api/v1/pumpfun/coin/{contract_address}") 
+async def get_pumpfun_coin_data(contract_address: str):
+    coins, errors = await lookup_pumpfun_coins([contract_address])
+    if contract_address in errors:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=f"Không thể lấy dữ liệu từ Pump.fun: {errors[contract_address]}")
+    if coins.get(contract_address) is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Không tìm thấy token trên Pump.fun.")
+    return coins[contract_address]
+
+@app.get("/api/v1/pumpfun/coins")
+async def get_pumpfun_coins_data(addresses: str):
+    """
+    Tra cứu nhiều token Pump.fun trong 1 request, ví dụ: /api/v1/pumpfun/coins?addresses=MINT1,MINT2
+    Mint không tồn tại trả về null; mint lỗi upstream nằm trong "errors".
+    """
+    address_list = list(dict.fromkeys(a.strip() for a in addresses.split(",") if a.strip()))
+    if not address_list:
+        raise HTTPException(status_code=400, detail="Thiếu tham số addresses.")
+    if len(address_list) > PUMPFUN_BULK_MAX:
+        raise HTTPException(status_code=400, detail=f"Tối đa {PUMPFUN_BULK_MAX} địa chỉ mỗi request.")
+    coins, errors = await lookup_pumpfun_coins(address_list)
+    return {"coins": {a: coins.get(a) for a in address_list if a not in errors}, "errors": errors}
 
 # --- 11. Endpoint Create Token (Không đổi) ---
 @app.post("/api/v1/pumpfun/create_token")
@@ -173,88 +711,1111 @@ async def create_pumpfun_token(token_input: CreateTokenInput):
 
 
 # --- 12. ENDPOINT NÂNG CẤP: THỰC THI SWAP (JUPITER) ---
-@app.post("/api/v1/trade/execute")
-async def execute_trade(order: TradeOrder):
-    """
-    THỰC THI SWAP THẬT (Thay thế hàm mock).
-    Sử dụng Jupiter V6 API (Quote -> Swap -> Send).
-    """
-    global solana_client, http_client, creator_keypair
+# Pipeline swap tách thành 2 giai đoạn để endpoint batch có thể chạy song song phần chuẩn bị:
+# - prepare_swap: Quote -> lấy Transaction Swap (chỉ gọi HTTP, chạy song song được)
+# - submit_swap: Ký -> Gửi
+async def prepare_swap(order: TradeOrder) -> dict:
+    print(f"Nhận lệnh Swap: {order.amount} {order.input_symbol} -> {order.output_symbol}")
     
-    if solana_client is None or http_client is None or creator_keypair is None:
-        raise HTTPException(status_code=503, detail="Service chưa sẵn sàng (Solana/HTTP).")
+    # 1. Lấy địa chỉ Mint và Decimals
+    input_mint = MINT_ADDRESSES.get(order.input_symbol.upper())
+    output_mint = MINT_ADDRESSES.get(order.output_symbol.upper())
+    input_decimals = DECIMALS.get(order.input_symbol.upper())
+    
+    if not input_mint or not output_mint or not input_decimals:
+        raise HTTPException(status_code=400, detail="Token symbol không được hỗ trợ.")
 
-    try:
-        print(f"Nhận lệnh Swap: {order.amount} {order.input_symbol} -> {order.output_symbol}")
-        
-        # 1. Lấy địa chỉ Mint và Decimals
-        input_mint = MINT_ADDRESSES.get(order.input_symbol.upper())
-        output_mint = MINT_ADDRESSES.get(order.output_symbol.upper())
-        input_decimals = DECIMALS.get(order.input_symbol.upper())
-        
-        if not input_mint or not output_mint or not input_decimals:
-            raise HTTPException(status_code=400, detail="Token symbol không được hỗ trợ.")
-
-        # 2. Chuyển đổi số lượng sang đơn vị nhỏ nhất (Lamports)
-        amount_in_smallest_unit = int(order.amount * (10**input_decimals))
-
-        # --- BƯỚC 1: LẤY QUOTE ---
-        print(" - (1/3) Đang lấy Quote từ Jupiter...")
-        quote_params = {
-            "inputMint": input_mint,
-            "outputMint": output_mint,
-            "amount": amount_in_smallest_unit,
-            "slippageBps": order.slippage_bps
-        }
-        quote_response = await http_client.get(JUPITER_QUOTE_API, params=quote_params)
-        quote_response.raise_for_status()
-        quote_data = quote_response.json()
-        print(f" - Quote nhận được: {quote_data.get('outAmount')} {order.output_symbol}")
-
-        # --- BƯỚC 2: LẤY GIAO DỊCH SWAP ---
-        print(" - (2/3) Đang lấy Transaction Swap từ Jupiter...")
-        swap_payload = {
-            "quoteResponse": quote_data,
-            "userPublicKey": str(creator_keypair.pubkey()),
-            "wrapAndUnwrapSol": True, # Tự động wrap/unwrap SOL
-            "computeUnitPriceMicroLamports": 300_000 # Phí ưu tiên
-        }
-        swap_response = await http_client.post(JUPITER_SWAP_API, json=swap_payload)
-        swap_response.raise_for_status()
-        
+    # 2. Chuyển đổi số lượng sang đơn vị nhỏ nhất (Lamports), làm tròn theo bucket của quote cache
+    amount_in_smallest_unit = bucket_amount(int(order.amount * (10**input_decimals)))
+
+    # --- BƯỚC 1: LẤY QUOTE (có cache ngắn hạn) ---
+    print(" - (1/3) Đang lấy Quote từ Jupiter...")
+    max_age = QUOTE_CACHE_TTL if order.max_quote_age_ms is None else order.max_quote_age_ms / 1000
+    with timed("swap", "quote"):
+        quote_data = await get_jupiter_quote(
+            input_mint, output_mint, amount_in_smallest_unit, order.slippage_bps, max_age=max_age
+        )
+    print(f" - Quote nhận được: {quote_data.get('outAmount')} {order.output_symbol}")
+
+    # --- BƯỚC 2: LẤY GIAO DỊCH SWAP ---
+    print(" - (2/3) Đang lấy Transaction Swap từ Jupiter...")
+    priority_fee, fee_source = priority_fee_for(order.urgency)
+    swap_payload = {
+        "quoteResponse": quote_data,
+        "userPublicKey": str(creator_keypair.pubkey()),
+        "wrapAndUnwrapSol": True, # Tự động wrap/unwrap SOL
+        "computeUnitPriceMicroLamports": priority_fee # Phí ưu tiên theo urgency (bộ ước lượng nền)
+    }
+    # Không hedge bước build (POST), chỉ failover sang endpoint khác khi endpoint chính lỗi
+    with timed("swap", "swap_build"):
+        swap_response = await upstream_request("jupiter_swap", "POST", json=swap_payload)
+    swap_response.raise_for_status()
+    swap_data = swap_response.json()
+    
+    return {
+        "order": order,
+        "quote": quote_data,
         # Lấy chuỗi base64 của giao dịch
-        swap_tx_b64 = swap_response.json()['swapTransaction']
+        "swap_tx_b64": swap_data['swapTransaction'],
+        "input_amount": amount_in_smallest_unit / (10**input_decimals),
+        "priority_fee": priority_fee,
+        "priority_fee_source": fee_source,
+        # Jupiter trả tổng phí ưu tiên (lamports) = giá CU * compute unit limit
+        "priority_fee_lamports": swap_data.get("prioritizationFeeLamports"),
+    }
 
-        # --- BƯỚC 3: KÝ VÀ GỬI GIAO DỊCH ---
-        print(" - (3/3) Đang ký và gửi Transaction...")
-        
+async def submit_swap(prepared: dict) -> dict:
+    order = prepared["order"]
+    quote_data = prepared["quote"]
+
+    # --- BƯỚC 3: KÝ VÀ GỬI GIAO DỊCH ---
+    print(" - (3/3) Đang ký và gửi Transaction...")
+    
+    with timed("swap", "sign"):
         # Decode base64
-        raw_tx_bytes = base64.b64decode(swap_tx_b64)
+        raw_tx_bytes = base64.b64decode(prepared["swap_tx_b64"])
         # Deserialize thành VersionedTransaction
         tx = VersionedTransaction.from_bytes(raw_tx_bytes)
         
         # Ký giao dịch bằng Private Key của bạn
-        tx.sign([creator_keypair])
-        
-        # Gửi giao dịch
-        opts = TxOpts(skip_preflight=True, preflight_commitment=Confirmed)
-        tx_sig = solana_client.send_transaction(tx, opts=opts).value
-        
-        print(f" - GIAO DỊCH SWAP THÀNH CÔNG! Signature: {tx_sig}")
+        # (VersionedTransaction của solders không có .sign(): tạo lại giao dịch kèm chữ ký)
+        tx = VersionedTransaction(tx.message, [creator_keypair])
+    
+    # Gửi giao dịch (async, không chặn event loop). Xác nhận được theo dõi ở nền.
+    # Endpoint RPC lỗi -> gửi lại đúng giao dịch đã ký sang endpoint kế tiếp (cùng chữ ký nên không bị
+    # thực thi 2 lần); không hedge để tránh nhân đôi tải sendTransaction.
+    opts = TxOpts(skip_preflight=True, preflight_commitment=Confirmed)
+    with timed("swap", "send"):
+        tx_sig = (await upstreams["solana_rpc"].call(
+            lambda url: solana_clients[url].send_transaction(tx, opts=opts)
+        )).value
+    track_signature(str(tx_sig), urgency=order.urgency, priority_fee=prepared["priority_fee"])
+    PRIORITY_FEE.labels(order.urgency).observe(prepared["priority_fee"])
+    if prepared["priority_fee_lamports"]:
+        PRIORITY_FEE_SPEND.labels(order.urgency).inc(prepared["priority_fee_lamports"])
+    record_swap_tick(order, prepared["input_amount"], int(quote_data.get('outAmount')))
+    
+    print(f" - ĐÃ GỬI GIAO DỊCH SWAP! Signature: {tx_sig}")
 
-        return {
-            "status": "success",
-            "message": "Swap đã được thực thi thành công!",
-            "input_token": order.input_symbol,
-            "output_token": order.output_symbol,
-            "input_amount": order.amount,
-            "output_amount_prediction": int(quote_data.get('outAmount')) / (10**DECIMALS.get(order.output_symbol.upper(), 6)),
-            "tx_id": str(tx_sig)
-        }
+    return {
+        "status": "submitted",
+        "message": "Swap đã được gửi, đang chờ xác nhận.",
+        "input_token": order.input_symbol,
+        "output_token": order.output_symbol,
+        "input_amount": prepared["input_amount"],
+        "output_amount_prediction": int(quote_data.get('outAmount')) / (10**DECIMALS.get(order.output_symbol.upper(), 6)),
+        "tx_id": str(tx_sig),
+        "status_url": f"/api/v1/trade/status/{tx_sig}",
+        "urgency": order.urgency,
+        "priority_fee_micro_lamports": prepared["priority_fee"],
+        "priority_fee_source": prepared["priority_fee_source"],
+    }
+
+def ensure_trading_ready():
+    if solana_client is None or http_client is None or creator_keypair is None:
+        raise HTTPException(status_code=503, detail="Service chưa sẵn sàng (Solana/HTTP).")
+
+@app.post("/api/v1/trade/execute")
+async def execute_trade(order: TradeOrder):
+    """
+    THỰC THI SWAP THẬT (Thay thế hàm mock).
+    Sử dụng Jupiter V6 API (Quote -> Swap -> Send).
+    """
+    ensure_trading_ready()
 
+    try:
+        prepared = await prepare_swap(order)
+        return await submit_swap(prepared)
+
+    except HTTPException:
+        raise
+    except UpstreamUnavailable as e:
+        # Không dùng quote cũ để khớp lệnh: báo lỗi ngay để client thử lại sau
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=f"Upstream tạm ngưng: {e}")
     except Exception as e:
         print(f"LỖI trong quá trình Swap: {e}")
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Lỗi khi thực thi swap: {e}"
-        )
\ No newline at end of file
+        )
+
+class BatchTradeRequest(BaseModel):
+    orders: list[TradeOrder]
+
+@app.post("/api/v1/trade/batch")
+async def execute_trade_batch(batch: BatchTradeRequest):
+    """
+    Thực thi nhiều lệnh swap trong 1 request (ví dụ: rebalance nhiều token).
+    Quote + lấy Transaction của các lệnh chạy song song (tối đa TRADE_BATCH_CONCURRENCY lệnh cùng lúc),
+    sau đó ký và gửi theo đúng thứ tự lệnh. Lệnh lỗi không làm hỏng các lệnh khác.
+    """
+    ensure_trading_ready()
+    if not batch.orders:
+        raise HTTPException(status_code=400, detail="Danh sách lệnh rỗng.")
+    if len(batch.orders) > TRADE_BATCH_MAX_ORDERS:
+        raise HTTPException(status_code=400, detail=f"Tối đa {TRADE_BATCH_MAX_ORDERS} lệnh mỗi batch.")
+
+    semaphore = asyncio.Semaphore(TRADE_BATCH_CONCURRENCY)
+
+    async def prepare_limited(order: TradeOrder):
+        async with semaphore:
+            return await prepare_swap(order)
+
+    prepared_list = await asyncio.gather(
+        *(prepare_limited(order) for order in batch.orders), return_exceptions=True
+    )
+
+    results = []
+    for index, prepared in enumerate(prepared_list):
+        if isinstance(prepared, BaseException):
+            results.append({"index": index, **batch_error_result(prepared)})
+            continue
+        try:
+            results.append({"index": index, **(await submit_swap(prepared))})
+        except Exception as e:
+            results.append({"index": index, **batch_error_result(e)})
+
+    succeeded = sum(1 for r in results if r["status"] == "submitted")
+    return {"total": len(results), "submitted": succeeded, "failed": len(results) - succeeded, "results": results}
+
+def batch_error_result(error: BaseException) -> dict:
+    print(f"LỖI trong lệnh batch: {error}")
+    detail = error.detail if isinstance(error, HTTPException) else f"Lỗi khi thực thi swap: {error}"
+    return {"status": "error", "detail": detail}
+
+# --- 13. THEO DÕI XÁC NHẬN GIAO DỊCH (BATCH) ---
+def track_signature(signature: str, urgency: str = "normal", priority_fee: int | None = None):
+    tracked_signatures[signature] = {
+        "signature": signature,
+        "urgency": urgency,
+        "priority_fee": priority_fee,
+        "status": "pending",
+        "confirmation_status": None,
+        "slot": None,
+        "error": None,
+        "submitted_at": time.time(),
+        "finished_at": None,
+    }
+    signature_events[signature] = asyncio.Event()
+
+def finish_signature(signature: str, status_value: str, **fields):
+    record = tracked_signatures.get(signature)
+    if record is None or record["status"] != "pending":
+        return
+    record.update(fields, status=status_value, finished_at=time.time())
+    LAND_LATENCY.labels(record["urgency"], status_value).observe(record["finished_at"] - record["submitted_at"])
+    event = signature_events.get(signature)
+    if event:
+        event.set()
+
+async def poll_signature_statuses():
+    """Gom mọi chữ ký đang chờ vào các lần gọi getSignatureStatuses (tối đa 256 chữ ký/lần)."""
+    now = time.time()
+    for signature, record in list(tracked_signatures.items()):
+        if record["finished_at"] and now - record["finished_at"] > SIGNATURE_RESULT_TTL:
+            tracked_signatures.pop(signature, None)
+            signature_events.pop(signature, None)
+
+    pending = [sig for sig, rec in tracked_signatures.items() if rec["status"] == "pending"]
+    if not pending or solana_client is None:
+        return
+    for i in range(0, len(pending), SIGNATURE_STATUS_BATCH):
+        chunk = pending[i:i + SIGNATURE_STATUS_BATCH]
+        try:
+            signatures = [Signature.from_string(sig) for sig in chunk]
+            response = await upstreams["solana_rpc"].call(
+                lambda url: solana_clients[url].get_signature_statuses(signatures), hedge=True
+            )
+        except Exception as e:
+            print(f"Lỗi khi gọi getSignatureStatuses: {e}")
+            continue
+        for signature, tx_status in zip(chunk, response.value):
+            record = tracked_signatures.get(signature)
+            if record is None:
+                continue
+            if tx_status is None:
+                if now - record["submitted_at"] > SIGNATURE_TRACK_TIMEOUT:
+                    finish_signature(signature, "expired")
+                continue
+            record["slot"] = tx_status.slot
+            record["confirmation_status"] = (
+                str(tx_status.confirmation_status).split(".")[-1].lower()
+                if tx_status.confirmation_status is not None else None
+            )
+            if tx_status.err is not None:
+                finish_signature(signature, "failed", error=str(tx_status.err))
+            elif tx_status.confirmation_status in (
+                TransactionConfirmationStatus.Confirmed, TransactionConfirmationStatus.Finalized
+            ):
+                finish_signature(signature, "confirmed")
+
+async def confirmation_tracker_loop():
+    print("Đã khởi động bộ theo dõi xác nhận giao dịch.")
+    while True:
+        await asyncio.sleep(SIGNATURE_POLL_INTERVAL)
+        try:
+            await poll_signature_statuses()
+        except Exception as e:
+            print(f"Lỗi trong bộ theo dõi xác nhận: {e}")
+
+@app.get("/api/v1/trade/status/{signature}")
+async def get_trade_status(signature: str, wait: float = 0):
+    """
+    Trạng thái xác nhận của giao dịch đã gửi.
+    `wait` > 0: giữ kết nối tối đa `wait` giây cho đến khi giao dịch có kết quả cuối (long-poll).
+    """
+    record = tracked_signatures.get(signature)
+    if record is None:
+        raise HTTPException(status_code=404, detail="Không tìm thấy giao dịch (chưa gửi hoặc đã hết hạn theo dõi).")
+    event = signature_events.get(signature)
+    if wait > 0 and event is not None and record["status"] == "pending":
+        try:
+            await asyncio.wait_for(event.wait(), timeout=min(wait, SIGNATURE_TRACK_TIMEOUT))
+        except asyncio.TimeoutError:
+            pass
+    return record
+
+
+# --- 14. LUỒNG GIÁ REAL-TIME (POLLER NỀN + REDIS PUB/SUB + SSE) ---
+async def price_ingestion_loop():
+    """
+    Vòng lặp duy nhất lấy giá cho PRICE_STREAM_SYMBOLS: mỗi nhịp chỉ 1 lần gọi Jupiter (bulk),
+    giá nào thay đổi thì publish lên Redis để mọi client/replica cùng nhận.
+    """
+    print(f"Đã khởi động price poller: {PRICE_STREAM_SYMBOLS} mỗi {PRICE_STREAM_INTERVAL}s")
+    last_published: dict[str, float] = {}
+    while True:
+        started = time.monotonic()
+        try:
+            tasks = fetch_prices_single_flight(PRICE_STREAM_SYMBOLS)
+            prices = await asyncio.gather(*(asyncio.shield(tasks[s]) for s in PRICE_STREAM_SYMBOLS))
+            updates = [
+                {"symbol": symbol, "price": price, "source": "Stream (Jupiter)", "ts": time.time()}
+                for symbol, price in zip(PRICE_STREAM_SYMBOLS, prices)
+                if price is not None and last_published.get(symbol) != price
+            ]
+            if updates and redis_client is not None:
+                pipe = redis_client.pipeline(transaction=False)
+                for update in updates:
+                    pipe.publish(PRICE_STREAM_CHANNEL, json.dumps(update))
+                pipe.execute()
+                for update in updates:
+                    last_published[update["symbol"]] = update["price"]
+        except Exception as e:
+            print(f"Lỗi trong price poller: {e}")
+        await asyncio.sleep(max(0.0, PRICE_STREAM_INTERVAL - (time.monotonic() - started)))
+
+def broadcast_price(update: dict):
+    latest_prices[update["symbol"]] = update
+    for queue in price_subscribers:
+        if queue.full():
+            queue.get_nowait()
+        queue.put_nowait(update)
+
+async def price_stream_listener():
+    """1 kết nối pub/sub mỗi process, phát lại cho tất cả client SSE trong process."""
+    while True:
+        try:
+            async with aioredis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=0, decode_responses=True) as pubsub_client:
+                async with pubsub_client.pubsub() as pubsub:
+                    await pubsub.subscribe(PRICE_STREAM_CHANNEL)
+                    print(f"Đã subscribe kênh Redis: {PRICE_STREAM_CHANNEL}")
+                    async for message in pubsub.listen():
+                        if message.get("type") == "message":
+                            broadcast_price(json.loads(message["data"]))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Lỗi Redis pub/sub, thử lại sau 1s: {e}")
+            await asyncio.sleep(1)
+
+@app.get("/api/v1/prices/stream")
+async def stream_prices(request: Request, symbols: str | None = None):
+    """
+    Server-Sent Events: đẩy giá ngay khi poller nền có giá mới.
+    `symbols` (tùy chọn): lọc theo danh sách cặp, ví dụ SOL-USDT,BONK-USDC
+    """
+    wanted = {s.strip() for s in symbols.split(",") if s.strip()} if symbols else None
+    queue: asyncio.Queue = asyncio.Queue(maxsize=PRICE_STREAM_QUEUE_SIZE)
+    price_subscribers.add(queue)
+
+    async def event_source():
+        try:
+            # Gửi ngay giá mới nhất đang có để client không phải chờ nhịp kế tiếp
+            for update in list(latest_prices.values()):
+                if wanted is None or update["symbol"] in wanted:
+                    yield f"event: price-update\ndata: {json.dumps(update)}\n\n"
+            while not await request.is_disconnected():
+                try:
+                    update = await asyncio.wait_for(queue.get(), timeout=15)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+                    continue
+                if wanted is None or update["symbol"] in wanted:
+                    yield f"event: price-update\ndata: {json.dumps(update)}\n\n"
+        finally:
+            price_subscribers.discard(queue)
+
+    return StreamingResponse(
+        event_source(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+# --- 15. CACHE QUOTE JUPITER (TTL NGẮN + BUCKET SỐ LƯỢNG + PREFETCH) ---
+def bucket_amount(amount: int) -> int:
+    """Làm tròn xuống số lượng (đơn vị nhỏ nhất) về QUOTE_AMOUNT_SIG_DIGITS chữ số có nghĩa (không vượt số yêu cầu)."""
+    if QUOTE_AMOUNT_SIG_DIGITS <= 0 or amount <= 0:
+        return amount
+    scale = 10 ** max(0, len(str(amount)) - QUOTE_AMOUNT_SIG_DIGITS)
+    return amount // scale * scale
+
+async def fetch_jupiter_quote(input_mint: str, output_mint: str, amount: int, slippage_bps: int) -> dict:
+    quote_params = {
+        "inputMint": input_mint,
+        "outputMint": output_mint,
+        "amount": amount,
+        "slippageBps": slippage_bps
+    }
+    quote_response = await upstream_request("jupiter_quote", "GET", params=quote_params, hedge=True)
+    quote_response.raise_for_status()
+    return quote_response.json()
+
+def store_quote(key: tuple, quote: dict):
+    now = time.monotonic()
+    if len(quote_cache) >= QUOTE_CACHE_MAX_ENTRIES:
+        for old_key, (fetched_at, _) in list(quote_cache.items()):
+            if now - fetched_at > QUOTE_CACHE_TTL:
+                del quote_cache[old_key]
+        while len(quote_cache) >= QUOTE_CACHE_MAX_ENTRIES:
+            del quote_cache[next(iter(quote_cache))]
+    quote_cache.pop(key, None)
+    quote_cache[key] = (now, quote)
+
+async def refresh_quote(key: tuple) -> dict:
+    try:
+        quote = await fetch_jupiter_quote(*key)
+    except Exception:
+        quote_cache_stats["errors"] += 1
+        raise
+    store_quote(key, quote)
+    return quote
+
+def fetch_quote_single_flight(key: tuple) -> asyncio.Task:
+    task = quote_inflight.get(key)
+    if task is None:
+        task = asyncio.create_task(refresh_quote(key))
+        quote_inflight[key] = task
+
+        def _done(t: asyncio.Task):
+            if quote_inflight.get(key) is t:
+                del quote_inflight[key]
+            if not t.cancelled():
+                t.exception()  # tránh cảnh báo "exception was never retrieved"
+        task.add_done_callback(_done)
+    return task
+
+async def get_jupiter_quote(input_mint: str, output_mint: str, amount: int, slippage_bps: int,
+                            max_age: float = QUOTE_CACHE_TTL) -> dict:
+    """
+    Quote từ cache nếu còn mới hơn min(max_age, QUOTE_CACHE_TTL), ngược lại gọi Jupiter
+    (các lệnh đồng thời cùng key dùng chung 1 lần gọi).
+    """
+    key = (input_mint, output_mint, amount, slippage_bps)
+    entry = quote_cache.get(key)
+    if entry is not None:
+        if time.monotonic() - entry[0] <= min(max_age, QUOTE_CACHE_TTL):
+            quote_cache_stats["hits"] += 1
+            CACHE_RESULTS.labels("quote", "hit").inc()
+            return entry[1]
+        quote_cache_stats["expired"] += 1
+        CACHE_RESULTS.labels("quote", "expired").inc()
+    else:
+        quote_cache_stats["misses"] += 1
+        CACHE_RESULTS.labels("quote", "miss").inc()
+        # Có quote cùng cặp/slippage nhưng khác bucket -> gợi ý bucket đang quá mịn
+        if any(k[0] == input_mint and k[1] == output_mint and k[3] == slippage_bps for k in quote_cache):
+            quote_cache_stats["near_misses"] += 1
+    return await asyncio.shield(fetch_quote_single_flight(key))
+
+def parse_quote_prefetch_pairs() -> list[tuple]:
+    keys = []
+    for item in QUOTE_PREFETCH_PAIRS.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        try:
+            pair, amount = item.split(":")
+            input_symbol, output_symbol = pair.upper().split("-")
+            input_decimals = DECIMALS[input_symbol]
+            keys.append((
+                MINT_ADDRESSES[input_symbol], MINT_ADDRESSES[output_symbol],
+                bucket_amount(int(float(amount) * (10**input_decimals))), 50
+            ))
+        except (KeyError, ValueError):
+            print(f"Bỏ qua cặp prefetch không hợp lệ: {item}")
+    return keys
+
+async def quote_prefetch_loop():
+    """Làm mới quote cho các cặp nóng trước khi hết TTL để lệnh thật luôn trúng cache."""
+    keys = parse_quote_prefetch_pairs()
+    print(f"Đã khởi động quote prefetcher: {len(keys)} cặp mỗi {QUOTE_PREFETCH_INTERVAL}s")
+    while keys:
+        results = await asyncio.gather(
+            *(fetch_quote_single_flight(key) for key in keys), return_exceptions=True
+        )
+        quote_cache_stats["prefetches"] += sum(1 for r in results if not isinstance(r, BaseException))
+        await asyncio.sleep(QUOTE_PREFETCH_INTERVAL)
+
+@app.get("/api/v1/trade/quote-cache/stats")
+async def get_quote_cache_stats():
+    lookups = quote_cache_stats["hits"] + quote_cache_stats["misses"] + quote_cache_stats["expired"]
+    return {
+        **quote_cache_stats,
+        "hit_ratio": round(quote_cache_stats["hits"] / lookups, 4) if lookups else None,
+        "entries": len(quote_cache),
+        "ttl_seconds": QUOTE_CACHE_TTL,
+        "amount_sig_digits": QUOTE_AMOUNT_SIG_DIGITS,
+    }
+
+# --- 16. CHUỖI TICK GIÁ (NUMPY RING BUFFER) + CHỈ BÁO KỸ THUẬT ---
+class TickRing:
+    """
+    Ring buffer cố định cho 1 symbol: 3 cột float64 (ts, price, volume).
+    Mỗi tick được ghi 2 lần (vị trí i và i + size) nên N tick gần nhất luôn là 1 slice
+    liền mạch theo thứ tự thời gian -> đọc không cần copy / np.roll. Bộ nhớ: 2 * 3 * 8 * size byte.
+    """
+    __slots__ = ("size", "data", "next", "count")
+
+    def __init__(self, size: int):
+        self.size = size
+        self.data = np.zeros((3, 2 * size), dtype=np.float64)
+        self.next = 0
+        self.count = 0
+
+    def append(self, ts: float, price: float, volume: float):
+        column = (ts, price, volume)
+        self.data[:, self.next] = column
+        self.data[:, self.next + self.size] = column
+        self.next = (self.next + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+
+    def latest(self) -> np.ndarray:
+        """View (3, count) các tick theo thứ tự cũ -> mới."""
+        end = self.next + self.size
+        return self.data[:, end - self.count:end]
+
+tick_buffers: OrderedDict[str, TickRing] = OrderedDict()
+
+def record_tick(symbol: str, price: float, volume: float = 0.0, ts: float | None = None):
+    """Ghi 1 tick giá (gọi từ đường lấy giá Jupiter; volume > 0 khi tick đến từ lệnh swap)."""
+    ring = tick_buffers.get(symbol)
+    if ring is None:
+        ring = tick_buffers[symbol] = TickRing(TICK_BUFFER_SIZE)
+        while len(tick_buffers) > TICK_MAX_SYMBOLS:
+            tick_buffers.popitem(last=False)
+    tick_buffers.move_to_end(symbol)
+    ts = time.time() if ts is None else ts
+    ring.append(ts, price, volume)
+    archive_tick(symbol, ts, price)
+
+def record_swap_tick(order: TradeOrder, input_amount: float, out_amount_raw: int):
+    """
+    Jupiter price API không có khối lượng, nên VWAP dựa trên các lệnh swap của chính service:
+    ghi giá khớp (theo quote) + khối lượng vào cặp BASE-QUOTE (QUOTE là USDC/USDT nếu có).
+    """
+    input_symbol, output_symbol = order.input_symbol.upper(), order.output_symbol.upper()
+    output_amount = out_amount_raw / (10**DECIMALS.get(output_symbol, 6))
+    if not input_amount or not output_amount:
+        return
+    if input_symbol in QUOTE_SYMBOLS:
+        record_tick(f"{output_symbol}-{input_symbol}", input_amount / output_amount, volume=output_amount)
+    else:
+        record_tick(f"{input_symbol}-{output_symbol}", output_amount / input_amount, volume=input_amount)
+
+def ema_last(prices: np.ndarray, span: int) -> float:
+    """EMA tại điểm cuối, dạng đóng (adjust=True như pandas): trung bình trọng số (1-alpha)^k, không lặp từng tick."""
+    alpha = 2.0 / (span + 1)
+    weights = (1.0 - alpha) ** np.arange(len(prices) - 1, -1, -1, dtype=np.float64)
+    return float(weights @ prices / weights.sum())
+
+def compute_indicators(ticks: np.ndarray, now: float, window: float, sma: int, ema: int,
+                       horizons: list[float]) -> dict:
+    ts_all = ticks[0]
+    # ts tăng dần -> tìm đầu cửa sổ bằng binary search
+    start = int(np.searchsorted(ts_all, now - window, side="left"))
+    ts, prices, volumes = ticks[0, start:], ticks[1, start:], ticks[2, start:]
+    n = len(prices)
+    if n == 0:
+        return {"ticks": 0}
+    result = {
+        "ticks": n,
+        "first_ts": float(ts[0]),
+        "last_ts": float(ts[-1]),
+        "last": float(prices[-1]),
+        "min": float(prices.min()),
+        "max": float(prices.max()),
+        "sma": float(prices[-sma:].mean()),
+        # Trọng số của tick cũ hơn ~4*span tick gần như bằng 0: bỏ qua cho nhanh
+        "ema": ema_last(prices[-4 * ema:], ema),
+    }
+    # VWAP (chỉ tính trên tick có khối lượng) + TWAP (trọng số = thời gian giá đứng yên)
+    volume_sum = float(volumes.sum())
+    result["vwap"] = float(prices @ volumes / volume_sum) if volume_sum > 0 else None
+    result["volume"] = volume_sum
+    if n > 1:
+        durations = np.diff(ts)
+        total = float(durations.sum())
+        result["twap"] = float(prices[:-1] @ durations / total) if total > 0 else float(prices.mean())
+        log_returns = np.diff(np.log(prices))
+        realized = float(np.sqrt(np.square(log_returns).sum()))
+        elapsed = float(ts[-1] - ts[0])
+        result["realized_volatility"] = realized
+        result["annualized_volatility"] = realized * math.sqrt(365 * 24 * 3600 / elapsed) if elapsed > 0 else None
+        result["window_return"] = float(prices[-1] / prices[0] - 1)
+    else:
+        result.update(twap=float(prices[0]), realized_volatility=None, annualized_volatility=None, window_return=None)
+    # Lợi suất theo từng mốc: giá mới nhất so với tick cuối cùng tại hoặc trước (now - h)
+    if horizons:
+        marks = np.searchsorted(ts_all, now - np.asarray(horizons, dtype=np.float64), side="right") - 1
+        result["returns"] = {
+            f"{h:g}s": (float(ticks[1, -1] / ticks[1, m] - 1) if m >= 0 else None)
+            for h, m in zip(horizons, marks.tolist())
+        }
+    return result
+
+@app.get("/api/v1/price/{symbol}/indicators")
+async def get_price_indicators(symbol: str, window: float = 300, sma: int = 20, ema: int = 20,
+                               horizons: str = "60,300,900"):
+    """
+    Chỉ báo trên chuỗi tick trong bộ nhớ của symbol, ví dụ:
+    /api/v1/price/SOL-USDT/indicators?window=600&sma=50&ema=20&horizons=60,300
+    - window: số giây nhìn lại; sma / ema: số tick; horizons: các mốc (giây) để tính lợi suất.
+    Tick chỉ có khi giá được lấy từ Jupiter (request giá, poller PRICE_STREAM_SYMBOLS) hoặc từ lệnh swap.
+    """
+    if window <= 0 or sma <= 0 or ema <= 0:
+        raise HTTPException(status_code=400, detail="window, sma, ema phải > 0.")
+    try:
+        horizon_list = [float(h) for h in horizons.split(",") if h.strip()]
+    except ValueError:
+        raise HTTPException(status_code=400, detail="horizons không hợp lệ.")
+    ring = tick_buffers.get(symbol)
+    if ring is None or ring.count == 0:
+        raise HTTPException(status_code=404, detail=f"Chưa có tick nào cho {symbol}.")
+    started = time.perf_counter()
+    with timed("indicators", "compute"):
+        result = compute_indicators(ring.latest(), time.time(), window, sma, ema, horizon_list)
+    return {
+        "symbol": symbol,
+        "window_seconds": window,
+        "buffered_ticks": ring.count,
+        **result,
+        "compute_us": round((time.perf_counter() - started) * 1e6, 1),
+    }
+
+# --- 17. KHO TICK TRÊN ĐĨA (CỘT CỐ ĐỊNH + MEMORY MAP) + NẾN OHLC ---
+# Mỗi symbol 1 thư mục, mỗi segment (TICK_SEGMENT_SECONDS) 2 file cột float64 chỉ ghi nối thêm:
+#   {TICK_ARCHIVE_DIR}/{symbol}/{segment_start}.ts   timestamp (tăng dần)
+#   {TICK_ARCHIVE_DIR}/{symbol}/{segment_start}.px   giá
+# Đọc qua np.memmap: binary search trên cột ts chỉ chạm vài page, chỉ phần nằm trong khoảng thời gian được đọc.
+TICK_DTYPE = np.dtype("<f8")
+ARCHIVE_SYMBOL_PATTERN = re.compile(r"^[A-Za-z0-9_]{1,32}-[A-Za-z0-9_]{1,32}$")
+tick_archive_pending: dict[str, list[tuple[float, float]]] = {}  # tick chờ ghi xuống đĩa (flush mỗi nhịp)
+tick_archive_stats = {"ticks_written": 0, "flushes": 0, "segments_deleted": 0, "errors": 0}
+
+def archive_tick(symbol: str, ts: float, price: float):
+    if TICK_ARCHIVE_DIR and ARCHIVE_SYMBOL_PATTERN.match(symbol):
+        tick_archive_pending.setdefault(symbol, []).append((ts, price))
+
+def segment_start(ts: float) -> int:
+    return int(ts // TICK_SEGMENT_SECONDS * TICK_SEGMENT_SECONDS)
+
+def write_archive_batch(batch: dict[str, list[tuple[float, float]]]) -> int:
+    """Ghi nối thêm vào file cột của segment tương ứng (chạy trong thread). -> số tick đã ghi."""
+    written = 0
+    for symbol, ticks in batch.items():
+        directory = os.path.join(TICK_ARCHIVE_DIR, symbol)
+        os.makedirs(directory, exist_ok=True)
+        columns = np.asarray(ticks, dtype=TICK_DTYPE)
+        segments = (columns[:, 0] // TICK_SEGMENT_SECONDS * TICK_SEGMENT_SECONDS).astype(np.int64)
+        # Tick đã theo thứ tự thời gian -> mỗi segment là 1 đoạn liên tiếp
+        bounds = np.flatnonzero(np.diff(segments)) + 1
+        for chunk, seg in zip(np.split(columns, bounds), segments[np.r_[0, bounds]].tolist()):
+            base = os.path.join(directory, str(seg))
+            with open(base + ".ts", "ab") as ts_file, open(base + ".px", "ab") as px_file:
+                np.ascontiguousarray(chunk[:, 0]).tofile(ts_file)
+                np.ascontiguousarray(chunk[:, 1]).tofile(px_file)
+            written += len(chunk)
+    return written
+
+async def flush_tick_archive():
+    global tick_archive_pending
+    if not tick_archive_pending:
+        return
+    batch, tick_archive_pending = tick_archive_pending, {}
+    try:
+        tick_archive_stats["ticks_written"] += await asyncio.to_thread(write_archive_batch, batch)
+        tick_archive_stats["flushes"] += 1
+    except Exception as e:
+        tick_archive_stats["errors"] += 1
+        print(f"Lỗi khi ghi kho tick: {e}")
+
+def list_segments(symbol: str) -> list[int]:
+    directory = os.path.join(TICK_ARCHIVE_DIR, symbol)
+    try:
+        names = os.listdir(directory)
+    except (FileNotFoundError, NotADirectoryError):
+        return []
+    return sorted(int(name[:-3]) for name in names if name.endswith(".ts") and name[:-3].isdigit())
+
+def open_segment(symbol: str, seg: int) -> tuple[np.ndarray, np.ndarray] | None:
+    """Memory map 2 cột của segment (chỉ đọc). Cột có thể lệch độ dài nếu đang ghi dở -> lấy phần chung."""
+    base = os.path.join(TICK_ARCHIVE_DIR, symbol, str(seg))
+    try:
+        count = min(os.path.getsize(base + ".ts"), os.path.getsize(base + ".px")) // TICK_DTYPE.itemsize
+    except FileNotFoundError:
+        return None
+    if count == 0:
+        return None
+    ts = np.memmap(base + ".ts", dtype=TICK_DTYPE, mode="r", shape=(count,))
+    px = np.memmap(base + ".px", dtype=TICK_DTYPE, mode="r", shape=(count,))
+    return ts, px
+
+def segment_bars(ts: np.ndarray, px: np.ndarray, start: float, interval: float) -> np.ndarray:
+    """Nến OHLC của 1 đoạn tick đã sắp xếp: (bucket, open, high, low, close, ticks), không lặp từng tick."""
+    buckets = ((ts - start) // interval).astype(np.int64)
+    starts = np.r_[0, np.flatnonzero(np.diff(buckets)) + 1]
+    ends = np.r_[starts[1:], len(ts)]
+    return np.column_stack((
+        buckets[starts],
+        px[starts],
+        np.maximum.reduceat(px, starts),
+        np.minimum.reduceat(px, starts),
+        px[ends - 1],
+        ends - starts,
+    ))
+
+def query_archive_bars(symbol: str, start: float, end: float, interval: float) -> tuple[list[dict], int]:
+    """-> (nến theo thời gian tăng dần, số tick đã dùng). Chỉ mở các segment giao với [start, end)."""
+    parts = []
+    total_ticks = 0
+    for seg in list_segments(symbol):
+        if seg + TICK_SEGMENT_SECONDS <= start or seg >= end:
+            continue
+        columns = open_segment(symbol, seg)
+        if columns is None:
+            continue
+        ts, px = columns
+        lo = int(np.searchsorted(ts, start, side="left"))
+        hi = int(np.searchsorted(ts, end, side="left"))
+        if hi > lo:
+            parts.append(segment_bars(np.asarray(ts[lo:hi]), np.asarray(px[lo:hi]), start, interval))
+            total_ticks += hi - lo
+    if not parts:
+        return [], 0
+    bars = np.concatenate(parts)
+    # Nến nằm vắt qua ranh giới 2 segment bị tách làm 2 dòng cùng bucket -> gộp lại
+    starts = np.r_[0, np.flatnonzero(np.diff(bars[:, 0])) + 1]
+    ends = np.r_[starts[1:], len(bars)]
+    merged = np.column_stack((
+        bars[starts, 0],
+        bars[starts, 1],
+        np.maximum.reduceat(bars[:, 2], starts),
+        np.minimum.reduceat(bars[:, 3], starts),
+        bars[ends - 1, 4],
+        np.add.reduceat(bars[:, 5], starts),
+    ))
+    return [
+        {"t": start + bucket * interval, "open": o, "high": h, "low": l, "close": c, "ticks": int(n)}
+        for bucket, o, h, l, c, n in merged.tolist()
+    ], total_ticks
+
+def apply_tick_retention() -> int:
+    """Xóa segment đã nằm trọn ngoài thời gian lưu giữ (và thư mục symbol đã rỗng). -> số segment đã xóa."""
+    cutoff = time.time() - TICK_RETENTION_DAYS * 86400
+    deleted = 0
+    for symbol in os.listdir(TICK_ARCHIVE_DIR):
+        for seg in list_segments(symbol):
+            if seg + TICK_SEGMENT_SECONDS > cutoff:
+                break  # segment đã sắp xếp, các segment sau đều mới hơn
+            for suffix in (".ts", ".px"):
+                try:
+                    os.remove(os.path.join(TICK_ARCHIVE_DIR, symbol, f"{seg}{suffix}"))
+                except FileNotFoundError:
+                    pass
+            deleted += 1
+        # Chạy tuần tự với flush trong tick_archive_loop nên không tranh chấp với lần ghi đang dở
+        directory = os.path.join(TICK_ARCHIVE_DIR, symbol)
+        if os.path.isdir(directory) and not os.listdir(directory):
+            os.rmdir(directory)
+    return deleted
+
+async def tick_archive_loop():
+    """Flush tick xuống đĩa mỗi TICK_ARCHIVE_FLUSH_INTERVAL giây, dọn segment hết hạn mỗi giờ."""
+    os.makedirs(TICK_ARCHIVE_DIR, exist_ok=True)
+    print(f"Đã khởi động kho tick: {TICK_ARCHIVE_DIR} (segment {TICK_SEGMENT_SECONDS}s, giữ {TICK_RETENTION_DAYS} ngày)")
+    next_retention = 0.0
+    while True:
+        await flush_tick_archive()
+        if time.monotonic() >= next_retention:
+            try:
+                tick_archive_stats["segments_deleted"] += await asyncio.to_thread(apply_tick_retention)
+            except Exception as e:
+                print(f"Lỗi khi dọn kho tick: {e}")
+            next_retention = time.monotonic() + 3600
+        await asyncio.sleep(TICK_ARCHIVE_FLUSH_INTERVAL)
+
+@app.get("/api/v1/price/{symbol}/bars")
+async def get_price_bars(symbol: str, start: float | None = None, end: float | None = None, interval: float = 60):
+    """
+    Nến OHLC từ kho tick trên đĩa, ví dụ: /api/v1/price/SOL-USDT/bars?start=1717000000&end=1717086400&interval=300
+    start / end: unix timestamp (giây, mặc định 1 giờ gần nhất); interval: độ dài 1 nến (giây).
+    Tick mới nhất có thể trễ tối đa TICK_ARCHIVE_FLUSH_INTERVAL giây.
+    """
+    if not TICK_ARCHIVE_DIR:
+        raise HTTPException(status_code=503, detail="Kho tick chưa được bật (TICK_ARCHIVE_DIR).")
+    if not ARCHIVE_SYMBOL_PATTERN.match(symbol):
+        raise HTTPException(status_code=400, detail="Symbol không hợp lệ.")
+    end = time.time() if end is None else end
+    start = end - 3600 if start is None else start
+    if interval <= 0 or end <= start:
+        raise HTTPException(status_code=400, detail="Cần interval > 0 và end > start.")
+    if (end - start) / interval > TICK_MAX_BARS:
+        raise HTTPException(status_code=400, detail=f"Tối đa {TICK_MAX_BARS} nến mỗi request, hãy tăng interval.")
+    with timed("bars", "archive_query"):
+        bars, ticks = await asyncio.to_thread(query_archive_bars, symbol, start, end, interval)
+    return {"symbol": symbol, "start": start, "end": end, "interval": interval, "ticks": ticks, "bars": bars}
+
+@app.get("/api/v1/price-archive/stats")
+async def get_tick_archive_stats():
+    return {
+        **tick_archive_stats,
+        "pending_ticks": sum(len(t) for t in tick_archive_pending.values()),
+        "directory": TICK_ARCHIVE_DIR or None,
+        "segment_seconds": TICK_SEGMENT_SECONDS,
+        "retention_days": TICK_RETENTION_DAYS,
+    }
+
+# --- 18. PHÍ ƯU TIÊN THÍCH ỨNG (getRecentPrioritizationFees) ---
+# Poller nền lấy phí ưu tiên của ~150 slot gần nhất, tính bảng percentile rồi chọn mức theo độ nghẽn:
+#   nghẽn = tỉ lệ slot có phí ưu tiên > 0 (thấp / bình thường / cao).
+# Mỗi mức nghẽn ánh xạ urgency (economy / normal / fast) sang 1 percentile khác nhau.
+PRIORITY_FEE = Histogram(
+    "trading_priority_fee_micro_lamports", "Phí ưu tiên (micro-lamports / CU) gắn vào lệnh swap",
+    ["urgency"], buckets=(1_000, 10_000, 50_000, 100_000, 300_000, 1_000_000, 3_000_000, 10_000_000),
+)
+PRIORITY_FEE_SPEND = Counter(
+    "trading_priority_fee_spend_lamports_total", "Tổng phí ưu tiên đã trả (lamports, theo Jupiter)", ["urgency"]
+)
+LAND_LATENCY = Histogram(
+    "trading_land_latency_seconds", "Thời gian từ lúc gửi đến khi giao dịch có kết quả cuối",
+    ["urgency", "status"], buckets=(0.5, 1, 2, 3, 5, 8, 13, 20, 30, 60, 90),
+)
+priority_fee_state = {
+    "level": None,          # low | normal | high
+    "percentiles": {},      # "p50" -> micro-lamports
+    "fees": {},             # urgency -> micro-lamports (đã áp min/max)
+    "nonzero_ratio": None,
+    "defaulted": [],        # urgency dùng mức mặc định vì percentile = 0
+    "samples": 0,
+    "updated_at": None,
+    "errors": 0,
+}
+
+def congestion_level(nonzero_ratio: float) -> str:
+    if nonzero_ratio >= PRIORITY_FEE_HIGH_CONGESTION:
+        return "high"
+    if nonzero_ratio >= PRIORITY_FEE_NORMAL_CONGESTION:
+        return "normal"
+    return "low"
+
+async def fetch_recent_prioritization_fees() -> list[int]:
+    """JSON-RPC getRecentPrioritizationFees (solana-py chưa có hàm riêng). -> phí mỗi slot (micro-lamports / CU)."""
+    payload = {
+        "jsonrpc": "2.0", "id": 1, "method": "getRecentPrioritizationFees",
+        "params": [PRIORITY_FEE_ACCOUNTS] if PRIORITY_FEE_ACCOUNTS else [],
+    }
+    with timed("priority_fee", "rpc"):
+        response = await upstream_request("solana_rpc", "POST", json=payload, hedge=True)
+    response.raise_for_status()
+    body = response.json()
+    if "error" in body:
+        raise Exception(body["error"])
+    return [item["prioritizationFee"] for item in body.get("result", [])]
+
+def update_priority_fee_table(samples: list[int]):
+    fees = np.asarray(samples, dtype=np.float64)
+    nonzero_ratio = float((fees > 0).mean())
+    level = congestion_level(nonzero_ratio)
+    percentiles = sorted({p for tiers in PRIORITY_FEE_TIER_PERCENTILES.values() for p in tiers.values()})
+    values = np.percentile(fees, percentiles)
+    table = {f"p{p}": int(v) for p, v in zip(percentiles, values)}
+    # Percentile = 0 nghĩa là không có dữ liệu cho tier đó: dùng mức mặc định thay vì kẹp về PRIORITY_FEE_MIN.
+    # Tier sau không bao giờ thấp hơn tier trước (fast >= normal >= economy).
+    fees, floor = {}, 0
+    for urgency, p in PRIORITY_FEE_TIER_PERCENTILES[level].items():
+        value = table[f"p{p}"]
+        fee = PRIORITY_FEE_DEFAULTS[urgency] if value <= 0 else min(PRIORITY_FEE_MAX, max(PRIORITY_FEE_MIN, value))
+        fees[urgency] = floor = max(floor, int(fee))
+    priority_fee_state.update(
+        level=level,
+        percentiles=table,
+        fees=fees,
+        defaulted=[u for u, p in PRIORITY_FEE_TIER_PERCENTILES[level].items() if table[f"p{p}"] <= 0],
+        nonzero_ratio=round(nonzero_ratio, 4),
+        samples=len(samples),
+        updated_at=time.time(),
+    )
+
+async def priority_fee_loop():
+    print(f"Đã khởi động bộ ước lượng phí ưu tiên (mỗi {PRIORITY_FEE_SAMPLE_INTERVAL}s)")
+    while True:
+        try:
+            samples = await fetch_recent_prioritization_fees()
+            if samples:
+                update_priority_fee_table(samples)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            priority_fee_state["errors"] += 1
+            print(f"Lỗi khi lấy phí ưu tiên: {e}")
+        await asyncio.sleep(PRIORITY_FEE_SAMPLE_INTERVAL)
+
+def priority_fee_for(urgency: str) -> tuple[int, str]:
+    """-> (micro-lamports / CU, nguồn). Bảng quá cũ hoặc chưa có -> mức mặc định của tier."""
+    updated_at = priority_fee_state["updated_at"]
+    if updated_at is not None and time.time() - updated_at < PRIORITY_FEE_MAX_AGE:
+        if urgency in priority_fee_state["defaulted"]:
+            return priority_fee_state["fees"][urgency], "default:no-data"
+        return priority_fee_state["fees"][urgency], f"estimator:{priority_fee_state['level']}"
+    return PRIORITY_FEE_DEFAULTS[urgency], "default"
+
+@app.get("/api/v1/trade/priority-fees")
+async def get_priority_fees():
+    """Bảng phí ưu tiên hiện tại (micro-lamports / CU) theo urgency."""
+    return {
+        **priority_fee_state,
+        "effective": {urgency: priority_fee_for(urgency)[0] for urgency in PRIORITY_FEE_DEFAULTS},
+        "tier_percentiles": PRIORITY_FEE_TIER_PERCENTILES,
+    }
+
+# --- 19. LỚP GỌI UPSTREAM (BUDGET ĐỘ TRỄ + HEDGING + CIRCUIT BREAKER + NHIỀU ENDPOINT) ---
+# Mọi lần gọi Jupiter / Pump.fun / Solana RPC đi qua Upstream.call():
+# - Budget: tổng thời gian tối đa của 1 lần gọi (kể cả hedge / failover), thay cho timeout chung 10s.
+# - Hedging (chỉ dùng cho đọc idempotent): quá p95 độ trễ gần đây mà chưa có kết quả thì gửi thêm
+#   1 bản sao sang endpoint kế tiếp, lấy kết quả về trước. Token bucket giới hạn số bản sao
+#   ở ~UPSTREAM_HEDGE_MAX_RATIO số lần gọi để không làm quá tải upstream.
+# - Failover: endpoint lỗi nhanh (kết nối, 5xx, 429) -> thử endpoint kế tiếp nếu còn budget.
+# - Circuit breaker mỗi endpoint: UPSTREAM_BREAKER_FAILURES lỗi liên tiếp -> mở, bỏ qua endpoint
+#   UPSTREAM_BREAKER_COOLDOWN giây rồi cho đúng 1 request thử (half-open). Mọi endpoint đều mở
+#   -> UpstreamUnavailable ngay lập tức, caller phục vụ từ cache (giá, coin Pump.fun).
+UPSTREAM_CALLS = Counter("trading_upstream_calls_total", "Lần gọi upstream theo kết quả", ["upstream", "result"])
+UPSTREAM_ATTEMPT_LATENCY = Histogram(
+    "trading_upstream_attempt_seconds", "Độ trễ mỗi lần thử thành công (gồm cả bản sao hedge)",
+    ["upstream"], buckets=LATENCY_BUCKETS,
+)
+UPSTREAM_HEDGES = Counter("trading_upstream_hedges_total", "Bản sao hedge đã gửi / thắng", ["upstream", "outcome"])
+UPSTREAM_BREAKER_TRIPS = Counter("trading_upstream_breaker_trips_total", "Số lần circuit breaker mở", ["upstream"])
+
+class UpstreamUnavailable(Exception):
+    """Mọi endpoint của upstream đang bị circuit breaker chặn."""
+
+def is_upstream_failure(error: BaseException) -> bool:
+    """Lỗi do upstream (tính vào breaker, được failover). Lỗi nghiệp vụ (4xx, RPC error) thì trả thẳng cho caller."""
+    return isinstance(error, (httpx.TransportError, httpx.HTTPStatusError, SolanaRpcException, TimeoutError))
+
+class Upstream:
+    """1 upstream (1 hoặc nhiều endpoint): budget, mẫu độ trễ để tính ngưỡng hedge, breaker mỗi endpoint."""
+
+    def __init__(self, name: str, endpoints: list[str], budget: float):
+        self.name = name
+        self.endpoints = endpoints
+        self.budget = budget
+        self.latencies: deque[float] = deque(maxlen=UPSTREAM_LATENCY_WINDOW)
+        self.hedge_threshold = budget / 2
+        self.samples_since_threshold = 0
+        self.hedge_tokens = UPSTREAM_HEDGE_BURST
+        self.breakers = {
+            endpoint: {"failures": 0, "opened_at": None, "probing": False, "trips": 0}
+            for endpoint in endpoints
+        }
+        self.stats = {"calls": 0, "errors": 0, "short_circuits": 0, "hedges": 0, "hedge_wins": 0, "failovers": 0}
+
+    def hedge_delay(self) -> float:
+        """p95 độ trễ gần đây (tính lại mỗi 32 mẫu), kẹp trong [UPSTREAM_HEDGE_MIN_DELAY, budget / 2]."""
+        if len(self.latencies) >= UPSTREAM_LATENCY_MIN_SAMPLES and self.samples_since_threshold >= 32:
+            self.hedge_threshold = float(np.percentile(self.latencies, UPSTREAM_HEDGE_PERCENTILE))
+            self.samples_since_threshold = 0
+        return min(self.budget / 2, max(UPSTREAM_HEDGE_MIN_DELAY, self.hedge_threshold))
+
+    def pick_endpoints(self) -> list[str]:
+        """Endpoint được phép gọi theo thứ tự ưu tiên; endpoint half-open (nếu có) đứng đầu để thử 1 lần."""
+        now = time.monotonic()
+        closed, probe = [], None
+        for endpoint, breaker in self.breakers.items():
+            if breaker["opened_at"] is None:
+                closed.append(endpoint)
+            elif probe is None and not breaker["probing"] and now - breaker["opened_at"] >= UPSTREAM_BREAKER_COOLDOWN:
+                breaker["probing"] = True
+                probe = endpoint
+        return [probe, *closed] if probe else closed
+
+    def record_success(self, endpoint: str, elapsed: float):
+        breaker = self.breakers[endpoint]
+        if breaker["probing"]:
+            print(f"Circuit breaker {self.name} ({endpoint}) đã đóng lại.")
+            breaker.update(failures=0, opened_at=None, probing=False)
+        elif breaker["opened_at"] is None:
+            breaker["failures"] = 0
+        # (request gửi trước khi breaker mở rồi mới thành công: chỉ request thử mới được đóng breaker)
+        self.latencies.append(elapsed)
+        self.samples_since_threshold += 1
+        UPSTREAM_ATTEMPT_LATENCY.labels(self.name).observe(elapsed)
+
+    def record_failure(self, endpoint: str, error: BaseException):
+        breaker = self.breakers[endpoint]
+        breaker["failures"] += 1
+        if breaker["probing"] or (breaker["opened_at"] is None and breaker["failures"] >= UPSTREAM_BREAKER_FAILURES):
+            if not breaker["probing"]:
+                print(f"Circuit breaker {self.name} ({endpoint}) MỞ sau {breaker['failures']} lỗi liên tiếp: {type(error).__name__}")
+                breaker["trips"] += 1
+                UPSTREAM_BREAKER_TRIPS.labels(self.name).inc()
+            breaker.update(opened_at=time.monotonic(), probing=False)
+
+    async def attempt(self, endpoint: str, call, deadline: float):
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        try:
+            result = await asyncio.wait_for(call(endpoint), timeout=max(0.0, deadline - loop.time()))
+        except asyncio.CancelledError:
+            # Bản thua trong hedge: không tính lỗi, trả lại quyền thử cho endpoint half-open
+            self.breakers[endpoint]["probing"] = False
+            raise
+        except Exception as e:
+            if is_upstream_failure(e):
+                self.record_failure(endpoint, e)
+            else:
+                self.breakers[endpoint]["probing"] = False
+            raise
+        self.record_success(endpoint, time.perf_counter() - started)
+        return result
+
+    async def call(self, call, hedge: bool = False):
+        """
+        call(endpoint) -> coroutine gọi 1 endpoint. hedge=True chỉ dùng cho thao tác đọc idempotent.
+        Endpoint lỗi nhanh luôn được failover sang endpoint kế tiếp (trong budget).
+        """
+        self.stats["calls"] += 1
+        endpoints = self.pick_endpoints()
+        if not endpoints:
+            self.stats["short_circuits"] += 1
+            UPSTREAM_CALLS.labels(self.name, "short_circuit").inc()
+            raise UpstreamUnavailable(f"{self.name}: circuit breaker đang mở")
+        self.hedge_tokens = min(UPSTREAM_HEDGE_BURST, self.hedge_tokens + UPSTREAM_HEDGE_MAX_RATIO)
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.budget
+        backups = iter(endpoints[1:])
+        tasks: dict[asyncio.Task, bool] = {  # task -> có phải bản sao hedge không
+            asyncio.create_task(self.attempt(endpoints[0], call, deadline)): False
+        }
+        hedge_at = loop.time() + self.hedge_delay() if hedge else None
+        last_error: BaseException | None = None
+        try:
+            while tasks:
+                timeout = None if hedge_at is None else max(0.0, hedge_at - loop.time())
+                done, _ = await asyncio.wait(tasks, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    # Quá ngưỡng p95 mà chưa có kết quả: gửi 1 bản sao nếu còn hạn mức hedge
+                    hedge_at = None
+                    if self.hedge_tokens >= 1:
+                        self.hedge_tokens -= 1
+                        self.stats["hedges"] += 1
+                        UPSTREAM_HEDGES.labels(self.name, "sent").inc()
+                        endpoint = next(backups, endpoints[0])
+                        tasks[asyncio.create_task(self.attempt(endpoint, call, deadline))] = True
+                    continue
+                for task in done:
+                    is_hedge = tasks.pop(task)
+                    error = task.exception()
+                    if error is None:
+                        if is_hedge:
+                            self.stats["hedge_wins"] += 1
+                            UPSTREAM_HEDGES.labels(self.name, "won").inc()
+                        UPSTREAM_CALLS.labels(self.name, "ok").inc()
+                        return task.result()
+                    if not is_upstream_failure(error):
+                        raise error
+                    last_error = error
+                if not tasks and loop.time() < deadline:
+                    endpoint = next(backups, None)
+                    if endpoint is not None:
+                        self.stats["failovers"] += 1
+                        tasks[asyncio.create_task(self.attempt(endpoint, call, deadline))] = False
+            raise last_error
+        except Exception:
+            self.stats["errors"] += 1
+            UPSTREAM_CALLS.labels(self.name, "error").inc()
+            raise
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def snapshot(self) -> dict:
+        now = time.monotonic()
+        return {
+            "budget_seconds": self.budget,
+            "hedge_delay_ms": round(self.hedge_delay() * 1000, 2),
+            "latency_samples": len(self.latencies),
+            **self.stats,
+            "endpoints": [
+                {
+                    "endpoint": endpoint,
+                    "state": "closed" if breaker["opened_at"] is None
+                    else "half_open" if breaker["probing"] or now - breaker["opened_at"] >= UPSTREAM_BREAKER_COOLDOWN
+                    else "open",
+                    "consecutive_failures": breaker["failures"],
+                    "trips": breaker["trips"],
+                }
+                for endpoint, breaker in self.breakers.items()
+            ],
+        }
+
+upstreams = {
+    name: Upstream(name, endpoints, UPSTREAM_BUDGETS[name])
+    for name, endpoints in {
+        "jupiter_price": JUPITER_PRICE_APIS,
+        "jupiter_quote": JUPITER_QUOTE_APIS,
+        "jupiter_swap": JUPITER_SWAP_APIS,
+        "pumpfun": PUMPFUN_APIS,
+        "solana_rpc": SOLANA_RPC_URLS,
+    }.items()
+}
+
+async def upstream_request(name: str, method: str, path: str = "", hedge: bool = False, **kwargs) -> httpx.Response:
+    """HTTP tới endpoint + path qua lớp upstream. 5xx / 429 tính là lỗi upstream; 4xx trả về cho caller xử lý."""
+    if not http_client:
+        raise Exception("HTTP Client chưa được khởi tạo")
+
+    async def call(endpoint: str) -> httpx.Response:
+        response = await http_client.request(method, endpoint + path, **kwargs)
+        if response.status_code >= 500 or response.status_code == 429:
+            response.raise_for_status()
+        return response
+    return await upstreams[name].call(call, hedge=hedge)
+
+def stale_tick_price(symbol: str) -> float | None:
+    """Giá của tick gần nhất trong bộ nhớ (mục 16) nếu chưa cũ hơn UPSTREAM_STALE_PRICE_MAX_AGE."""
+    ring = tick_buffers.get(symbol)
+    if ring is None or ring.count == 0:
+        return None
+    ts, price, _ = ring.latest()[:, -1]
+    if time.time() - ts > UPSTREAM_STALE_PRICE_MAX_AGE:
+        return None
+    return round(float(price), 6)
+
+@app.get("/api/v1/upstreams")
+async def get_upstream_stats():
+    """Budget, ngưỡng hedge hiện tại, thống kê hedge / failover và trạng thái breaker của từng endpoint."""
+    return {name: upstream.snapshot() for name, upstream in upstreams.items()}
@@ -0,0 +1,134 @@
+"""
+Server giả lập các upstream của trading-service để benchmark offline:
+Jupiter (quote / swap / price), Pump.fun (coins) và Solana JSON-RPC.
+
+Độ trễ và tỉ lệ lỗi cấu hình qua biến môi trường:
+    FAKE_LATENCY_MS   độ trễ cơ bản mỗi request (mặc định 50)
+    FAKE_JITTER_MS    cộng thêm ngẫu nhiên 0..JITTER (mặc định 20)
+    FAKE_ERROR_RATE   xác suất trả HTTP 500 (mặc định 0)
+    FAKE_SLOW_RATE    xác suất 1 request bị chậm bất thường (đuôi độ trễ, mặc định 0)
+    FAKE_SLOW_MS      độ trễ cộng thêm cho request chậm (mặc định 2000)
+    FAKE_CONFIRM_MS   thời gian từ sendTransaction đến khi 'confirmed' (mặc định 800)
+
+Chạy riêng: uvicorn fake_upstreams:app --port 9000
+"""
+import asyncio
+import base64
+import os
+import random
+import time
+
+from fastapi import FastAPI, HTTPException, Request
+from solders.hash import Hash
+from solders.message import MessageV0
+from solders.pubkey import Pubkey
+from solders.signature import Signature
+from solders.transaction import VersionedTransaction
+
+FAKE_LATENCY_MS = float(os.getenv("FAKE_LATENCY_MS", "50"))
+FAKE_JITTER_MS = float(os.getenv("FAKE_JITTER_MS", "20"))
+FAKE_ERROR_RATE = float(os.getenv("FAKE_ERROR_RATE", "0"))
+FAKE_SLOW_RATE = float(os.getenv("FAKE_SLOW_RATE", "0"))
+FAKE_SLOW_MS = float(os.getenv("FAKE_SLOW_MS", "2000"))
+FAKE_CONFIRM_MS = float(os.getenv("FAKE_CONFIRM_MS", "800"))
+
+app = FastAPI(title="Fake upstreams (Jupiter / Pump.fun / Solana RPC)")
+request_counts: dict[str, int] = {}
+sent_signatures: dict[str, float] = {}  # signature -> thời điểm gửi
+slot = 250_000_000
+
+
+async def simulate(endpoint: str):
+    """Độ trễ + lỗi giả lập, đồng thời đếm số lần upstream bị gọi."""
+    request_counts[endpoint] = request_counts.get(endpoint, 0) + 1
+    slow_ms = FAKE_SLOW_MS if random.random() < FAKE_SLOW_RATE else 0.0
+    await asyncio.sleep((FAKE_LATENCY_MS + random.random() * FAKE_JITTER_MS + slow_ms) / 1000)
+    if random.random() < FAKE_ERROR_RATE:
+        raise HTTPException(status_code=500, detail="fake upstream error")
+
+
+def fake_price(token: str) -> float:
+    # Giá ổn định theo token, dao động nhẹ theo thời gian
+    base = (sum(map(ord, token)) % 500) + 1
+    return round(base * (1 + 0.001 * random.uniform(-1, 1)), 6)
+
+
+@app.get("/price")
+async def price(ids: str, vsToken: str = "USDC"):
+    await simulate("price")
+    return {"data": {i: {"id": i, "mintSymbol": i, "vsTokenSymbol": vsToken, "price": fake_price(i)} for i in ids.split(",")}}
+
+
+@app.get("/quote")
+async def quote(inputMint: str, outputMint: str, amount: int, slippageBps: int = 50):
+    await simulate("quote")
+    return {
+        "inputMint": inputMint,
+        "outputMint": outputMint,
+        "inAmount": str(amount),
+        "outAmount": str(int(amount * 0.98)),
+        "slippageBps": slippageBps,
+        "routePlan": [],
+    }
+
+
+@app.post("/swap")
+async def swap(request: Request):
+    await simulate("swap")
+    payload = await request.json()
+    # Giao dịch chưa ký, payer = ví của trading-service (giống Jupiter thật)
+    message = MessageV0.try_compile(Pubkey.from_string(payload["userPublicKey"]), [], [], Hash.default())
+    tx = VersionedTransaction.populate(message, [Signature.default()])
+    compute_unit_limit = 200_000
+    priority_fee = int(payload.get("computeUnitPriceMicroLamports") or 0)
+    return {
+        "swapTransaction": base64.b64encode(bytes(tx)).decode(),
+        "computeUnitLimit": compute_unit_limit,
+        "prioritizationFeeLamports": priority_fee * compute_unit_limit // 1_000_000,
+    }
+
+
+@app.get("/coins/{mint}")
+async def coin(mint: str):
+    await simulate("coins")
+    if mint.startswith("unknown"):
+        raise HTTPException(status_code=404, detail="not found")
+    return {"mint": mint, "name": f"Coin {mint[:6]}", "symbol": mint[:4].upper(), "description": "fake", "market_cap": 12345.6}
+
+
+def rpc_result(request_id, result):
+    return {"jsonrpc": "2.0", "id": request_id, "result": result}
+
+
+@app.post("/")
+async def solana_rpc(request: Request):
+    body = await request.json()
+    method = body.get("method")
+    await simulate(f"rpc.{method}")
+    if method == "sendTransaction":
+        signature = str(Signature.new_unique())
+        sent_signatures[signature] = time.monotonic()
+        return rpc_result(body["id"], signature)
+    if method == "getSignatureStatuses":
+        now = time.monotonic()
+        statuses = []
+        for signature in body["params"][0]:
+            sent_at = sent_signatures.get(signature)
+            if sent_at is None:
+                statuses.append(None)
+            elif (now - sent_at) * 1000 < FAKE_CONFIRM_MS:
+                statuses.append({"slot": slot, "confirmations": 0, "err": None, "status": {"Ok": None}, "confirmationStatus": "processed"})
+            else:
+                statuses.append({"slot": slot, "confirmations": None, "err": None, "status": {"Ok": None}, "confirmationStatus": "confirmed"})
+        return rpc_result(body["id"], {"context": {"slot": slot}, "value": statuses})
+    if method == "getRecentPrioritizationFees":
+        # ~150 slot gần nhất, khoảng một nửa có phí ưu tiên
+        fees = [0 if random.random() < 0.5 else int(random.lognormvariate(11, 1.2)) for _ in range(150)]
+        return rpc_result(body["id"], [{"slot": slot - i, "prioritizationFee": fee} for i, fee in enumerate(fees)])
+    return {"jsonrpc": "2.0", "id": body.get("id"), "error": {"code": -32601, "message": f"Method not found: {method}"}}
+
+
+@app.get("/_stats")
+async def stats():
+    """Số lần mỗi upstream bị gọi (để kiểm tra cache / single-flight có tác dụng)."""
+    return request_counts
@@ -0,0 +1,202 @@
+"""
+Benchmark offline cho trading-service: không gọi mainnet, không gọi Jupiter/Pump.fun thật.
+
+1. Khởi động fake_upstreams.py (Jupiter / Pump.fun / Solana RPC giả lập) với độ trễ
+   và tỉ lệ lỗi cấu hình được.
+2. Khởi động trading-service trỏ vào các server giả lập đó (Redis trong bộ nhớ
+   bằng fakeredis, hoặc Redis thật qua --redis-host).
+3. Bắn tải vào từng endpoint với N kết nối đồng thời trong D giây, in ra
+   requests/s và p50/p95/p99 cho mỗi kịch bản.
+
+Ví dụ:
+    pip install -r requirements.txt -r ../requirements.txt
+    python loadtest.py --concurrency 50 --duration 15 --latency-ms 80 --error-rate 0.01
+    python loadtest.py --scenarios price,trade --max-p99-ms 250 --json result.json
+
+--max-p99-ms: thoát với mã 1 nếu kịch bản nào có p99 vượt ngưỡng (dùng để chặn regression trước khi deploy).
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+import based58
+import httpx
+from solders.keypair import Keypair
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+
+SCENARIOS = {
+    # tên: (method, hàm sinh (path, body))
+    "price": ("GET", lambda: ("/api/v1/price/SOL-USDT", None)),
+    "price_miss": ("GET", lambda: (f"/api/v1/price/T{random.randrange(10**9)}-USDC", None)),
+    "prices_bulk": ("GET", lambda: ("/api/v1/prices?symbols=" + ",".join(f"T{i}-USDC" for i in range(50)), None)),
+    "pumpfun": ("GET", lambda: (f"/api/v1/pumpfun/coin/Mint{random.randrange(200)}pump", None)),
+    "trade": ("POST", lambda: ("/api/v1/trade/execute", {
+        "input_symbol": "USDC", "output_symbol": "SOL", "amount": random.choice([5, 10, 25, 50]),
+    })),
+}
+
+
+def percentile(sorted_values: list[float], p: float) -> float:
+    if not sorted_values:
+        return float("nan")
+    index = min(len(sorted_values) - 1, max(0, round(p / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+async def run_scenario(base_url: str, name: str, concurrency: int, duration: float) -> dict:
+    method, make_request = SCENARIOS[name]
+    latencies: list[float] = []
+    errors = 0
+    deadline = time.perf_counter() + duration
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(base_url=base_url, timeout=30.0, limits=limits) as client:
+        async def worker():
+            nonlocal errors
+            while time.perf_counter() < deadline:
+                path, body = make_request()
+                started = time.perf_counter()
+                try:
+                    response = await client.request(method, path, json=body)
+                    if response.status_code >= 400:
+                        errors += 1
+                except httpx.HTTPError:
+                    errors += 1
+                latencies.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "scenario": name,
+        "requests": len(latencies),
+        "errors": errors,
+        "rps": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+    }
+
+
+def wait_until_up(url: str, timeout: float = 30.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            httpx.get(url, timeout=1.0)
+            return
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    raise RuntimeError(f"Không khởi động được: {url}")
+
+
+def start_processes(args, processes: list[subprocess.Popen]):
+    """Khởi động server giả lập + trading-service; tiến trình được thêm ngay vào `processes` để luôn dọn được."""
+    fake_env = {
+        **os.environ,
+        "FAKE_LATENCY_MS": str(args.latency_ms),
+        "FAKE_JITTER_MS": str(args.jitter_ms),
+        "FAKE_ERROR_RATE": str(args.error_rate),
+        "FAKE_SLOW_RATE": str(args.slow_rate),
+        "FAKE_SLOW_MS": str(args.slow_ms),
+    }
+    fake = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "fake_upstreams:app", "--port", str(args.fake_port), "--log-level", "warning"],
+        cwd=BENCH_DIR, env=fake_env,
+    )
+    processes.append(fake)
+    wait_until_up(f"http://127.0.0.1:{args.fake_port}/_stats")
+
+    fake_url = f"http://127.0.0.1:{args.fake_port}"
+    app_env = {
+        **os.environ,
+        "CREATOR_PRIVATE_KEY": based58.b58encode(bytes(Keypair())).decode(),
+        "SOLANA_RPC_URL": fake_url,
+        "JUPITER_QUOTE_API": f"{fake_url}/quote",
+        "JUPITER_SWAP_API": f"{fake_url}/swap",
+        "JUPITER_PRICE_API": f"{fake_url}/price",
+        "PUMPFUN_API": fake_url,
+        "REDIS_HOST": args.redis_host or "localhost",
+        "REDIS_PORT": str(args.redis_port),
+        # Kho tick trên đĩa: thư mục tạm, không ghi vào cây mã nguồn
+        "TICK_ARCHIVE_DIR": os.environ.get("TICK_ARCHIVE_DIR") or tempfile.mkdtemp(prefix="ticks-"),
+    }
+    command = [sys.executable, "serve_app.py", "--port", str(args.app_port)]
+    if not args.redis_host:
+        command.append("--fake-redis")
+    processes.append(subprocess.Popen(command, cwd=BENCH_DIR, env=app_env))
+    wait_until_up(f"http://127.0.0.1:{args.app_port}/metrics")
+
+
+def print_table(results: list[dict]):
+    header = f"{'scenario':<14}{'requests':>10}{'errors':>8}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}"
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        print(f"{r['scenario']:<14}{r['requests']:>10}{r['errors']:>8}{r['rps']:>10}{r['p50_ms']:>10}{r['p95_ms']:>10}{r['p99_ms']:>10}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="danh sách kịch bản, cách nhau bởi dấu phẩy")
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--duration", type=float, default=10.0, help="giây cho mỗi kịch bản")
+    parser.add_argument("--latency-ms", type=float, default=50.0, help="độ trễ upstream giả lập")
+    parser.add_argument("--jitter-ms", type=float, default=20.0)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="tỉ lệ lỗi upstream giả lập (0..1)")
+    parser.add_argument("--slow-rate", type=float, default=0.0, help="tỉ lệ request upstream chậm bất thường (0..1)")
+    parser.add_argument("--slow-ms", type=float, default=2000.0, help="độ trễ cộng thêm cho request chậm")
+    parser.add_argument("--app-port", type=int, default=18000)
+    parser.add_argument("--fake-port", type=int, default=19000)
+    parser.add_argument("--redis-host", default=None, help="dùng Redis thật thay vì fakeredis")
+    parser.add_argument("--redis-port", type=int, default=6379)
+    parser.add_argument("--max-p99-ms", type=float, default=None, help="ngưỡng p99 để báo regression")
+    parser.add_argument("--json", default=None, help="ghi kết quả ra file JSON")
+    args = parser.parse_args()
+
+    names = [n.strip() for n in args.scenarios.split(",") if n.strip()]
+    unknown = [n for n in names if n not in SCENARIOS]
+    if unknown:
+        parser.error(f"Kịch bản không tồn tại: {', '.join(unknown)}")
+
+    processes: list[subprocess.Popen] = []
+    try:
+        start_processes(args, processes)
+        base_url = f"http://127.0.0.1:{args.app_port}"
+        results = [asyncio.run(run_scenario(base_url, n, args.concurrency, args.duration)) for n in names]
+        upstream_calls = httpx.get(f"http://127.0.0.1:{args.fake_port}/_stats").json()
+        upstream_layer = httpx.get(f"{base_url}/api/v1/upstreams").json()
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait(timeout=10)
+
+    print_table(results)
+    print(f"\nSố lần gọi upstream: {upstream_calls}")
+    for name, layer in upstream_layer.items():
+        if layer["calls"]:
+            print(f"  {name}: calls={layer['calls']} hedges={layer['hedges']} (thắng {layer['hedge_wins']}) "
+                  f"failovers={layer['failovers']} short_circuits={layer['short_circuits']} hedge_delay={layer['hedge_delay_ms']}ms")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"config": vars(args), "results": results, "upstream_calls": upstream_calls,
+                       "upstream_layer": upstream_layer}, f, indent=2)
+
+    if args.max_p99_ms is not None:
+        regressions = [r for r in results if r["p99_ms"] > args.max_p99_ms]
+        if regressions:
+            print(f"\nREGRESSION: p99 vượt {args.max_p99_ms} ms: {', '.join(r['scenario'] for r in regressions)}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
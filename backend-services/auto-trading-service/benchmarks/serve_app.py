@@ -0,0 +1,44 @@
+"""
+Chạy trading-service (app/main.py) cho benchmark.
+Với --fake-redis: thay Redis thật bằng fakeredis trong bộ nhớ (dùng chung 1 server
+cho cả client sync lẫn client pub/sub async), không cần cài redis-server.
+
+Các URL upstream (Jupiter, Pump.fun, Solana RPC) được truyền qua biến môi trường
+bởi loadtest.py.
+"""
+import argparse
+import functools
+import os
+import sys
+
+import uvicorn
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app")
+
+
+def patch_redis_with_fakeredis():
+    import fakeredis
+    import redis
+    import redis.asyncio
+
+    server = fakeredis.FakeServer()
+    redis.Redis = functools.partial(fakeredis.FakeRedis, server=server)
+    redis.asyncio.Redis = functools.partial(fakeredis.aioredis.FakeRedis, server=server)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--fake-redis", action="store_true")
+    args = parser.parse_args()
+
+    if args.fake_redis:
+        patch_redis_with_fakeredis()
+    sys.path.insert(0, APP_DIR)
+    import main as trading_main
+
+    uvicorn.run(trading_main.app, host="127.0.0.1", port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
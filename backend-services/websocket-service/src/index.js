@@ -1,5 +1,5 @@
 import { Server } from "socket.io";
-import axios from "axios"; // <-- 1. Import axios
+import { createClient } from "redis"; // <-- 1. Nhận giá qua Redis pub/sub
 
 // Khởi tạo Socket.IO server trên cổng 8002
 const io = new Server(8002, {
@@ -11,50 +11,43 @@ const io = new Server(8002, {
 
 console.log("WebSocket Service đang chạy trên cổng 8002...");
 
-// --- 2. ĐỊNH NGHĨA URL CỦA TRADING SERVICE ---
-// (Sử dụng tên service 'trading-service' và cổng 8000
-// vì chúng giao tiếp nội bộ trong mạng Docker)
-const TRADING_SERVICE_URL = "http://trading-service:8000/api/v1/price/SOL-USDT";
+// --- 2. KÊNH REDIS PUB/SUB CỦA TRADING SERVICE ---
+// (trading-service có 1 poller nền duy nhất, publish giá mới lên kênh này.
+// Không còn vòng lặp HTTP 3 giây ở đây: giá được đẩy đi ngay khi có.)
+const REDIS_URL = `redis://${process.env.REDIS_HOST || "localhost"}:6379`;
+const PRICE_CHANNEL = "price-updates";
 
-// --- 3. HÀM MỚI: LẤY GIÁ THẬT VÀ PHÁT ĐI ---
-const fetchAndEmitPrice = async () => {
+// --- 3. NHẬN GIÁ VÀ PHÁT ĐI ---
+const handlePriceMessage = (message) => {
   try {
-    // console.log("Đang lấy giá thật từ trading-service...");
-    
-    // Gọi API (GET) đến trading-service
-    const response = await axios.get(TRADING_SERVICE_URL, {
-      timeout: 2500 // Timeout 2.5 giây
+    const update = JSON.parse(message);
+    // Gửi sự kiện 'price-update' đến TẤT CẢ client
+    io.emit("price-update", {
+      symbol: update.symbol,
+      price: update.price,
+      source: update.source,
     });
-
-    if (response.data && response.data.price) {
-      // Dữ liệu giá thật từ API
-      const priceUpdate = {
-        symbol: response.data.symbol,
-        price: response.data.price,
-        source: response.data.source, // Thêm nguồn (Cache / API)
-      };
-      
-      // Gửi sự kiện 'price-update' đến TẤT CẢ client
-      io.emit("price-update", priceUpdate);
-      // console.log(`Đã phát giá thật: ${priceUpdate.price}`);
-
-    }
   } catch (error) {
-    // Nếu trading-service lỗi (ví dụ: API Jupiter lỗi), chúng ta sẽ báo lỗi
-    console.error(`Lỗi khi lấy giá từ trading-service: ${error.message}`);
-    // Gửi thông báo lỗi (tùy chọn)
-    io.emit("price-error", { message: "Không thể lấy giá real-time." });
+    console.error(`Tin nhắn giá không hợp lệ: ${error.message}`);
   }
 };
 
-// --- 4. THAY THẾ LOGIC CŨ ---
-// Bỏ đoạn `setInterval` với `Math.random()`
+// --- 4. KẾT NỐI REDIS (tự kết nối lại nếu mất) ---
+const subscriber = createClient({ url: REDIS_URL });
+subscriber.on("error", (error) => {
+  console.error(`Lỗi Redis pub/sub: ${error.message}`);
+  io.emit("price-error", { message: "Không thể lấy giá real-time." });
+});
 
-// Cứ 3 giây gọi hàm lấy giá thật 1 lần
-setInterval(fetchAndEmitPrice, 3000); 
+const startPriceFeed = async () => {
+  await subscriber.connect();
+  await subscriber.subscribe(PRICE_CHANNEL, handlePriceMessage);
+  console.log(`Đã subscribe kênh Redis: ${PRICE_CHANNEL}`);
+};
 
-// Cũng gọi 1 lần ngay khi khởi động
-fetchAndEmitPrice();
+startPriceFeed().catch((error) => {
+  console.error(`Không thể khởi động price feed: ${error.message}`);
+});
 
 // --- 5. LOGIC KẾT NỐI (Không đổi) ---
 io.on("connection", (socket) => {